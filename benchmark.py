@@ -0,0 +1,217 @@
+import argparse
+import copy
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+from PIL import Image
+
+import weather_publisher as wp
+
+
+# --- Эталонные реализации (как было до оптимизаций) для сравнения «до/после» ---
+def legacy_add_watermark(img: Image.Image) -> Image.Image:
+    base = img.convert("RGBA")
+    if not os.path.exists(wp.WATERMARK_FILE): return base.convert("RGB")
+    watermark = Image.open(wp.WATERMARK_FILE).convert("RGBA")
+    w, h = base.size
+    target_w = int(w * wp.WATERMARK_SCALE_FACTOR)
+    h_size = int(watermark.height * (target_w / watermark.width))
+    watermark = watermark.resize((target_w, h_size), Image.Resampling.LANCZOS)
+    padding = int(w * 0.02)
+    pos = (w - watermark.width - padding, padding)
+    transparent = Image.new('RGBA', base.size, (0, 0, 0, 0)); transparent.paste(base, (0, 0))
+    transparent.paste(watermark, pos, mask=watermark)
+    return transparent.convert("RGB")
+
+
+def legacy_format_precipitation_forecast(weather_data: Dict) -> List[str]:
+    try:
+        hourly = weather_data.get('hourly', [])
+        offset = weather_data.get('timezone_offset', 0)
+        current_ts = weather_data.get('current', {}).get('dt')
+        if not hourly or not current_ts: return ["Осадков не ожидается"]
+
+        rainy_hours_data = []
+        for hour in hourly[:48]:
+            if hour.get('dt', 0) > current_ts and hour.get('pop', 0) > 0.35:
+                rainy_hours_data.append(hour)
+
+        if not rainy_hours_data: return ["Осадков не ожидается"]
+
+        intervals, i = [], 0
+        while i < len(rainy_hours_data):
+            start_hour_data, end_hour_data = rainy_hours_data[i], rainy_hours_data[i]
+            while i + 1 < len(rainy_hours_data) and rainy_hours_data[i+1]['dt'] == end_hour_data['dt'] + 3600:
+                end_hour_data = rainy_hours_data[i+1]
+                i += 1
+            intervals.append((start_hour_data, end_hour_data))
+            i += 1
+        
+        output_lines = []
+        for start_hour, end_hour in intervals[:2]:
+            start_dt = datetime.datetime.fromtimestamp(start_hour['dt'], tz=datetime.timezone.utc)
+            end_dt = datetime.datetime.fromtimestamp(end_hour['dt'], tz=datetime.timezone.utc)
+            
+            max_rain_volume, intensity_description = 0, "Дождь"
+            interval_hours = [h for h in hourly if start_hour['dt'] <= h['dt'] <= end_hour['dt']]
+            for hour in interval_hours:
+                rain_volume = hour.get('rain', {}).get('1h', 0)
+                if rain_volume > max_rain_volume:
+                    max_rain_volume = rain_volume
+                    intensity_description = hour.get('weather', [{}])[0].get('description', 'Дождь').capitalize()
+
+            local_start = start_dt + datetime.timedelta(seconds=offset)
+            local_end_display = end_dt + datetime.timedelta(hours=1) + datetime.timedelta(seconds=offset)
+
+            start_day_abbr = wp.DAY_ABBREVIATIONS[local_start.weekday()]
+            end_day_abbr = wp.DAY_ABBREVIATIONS[local_end_display.weekday()]
+
+            if local_start.day == local_end_display.day or local_end_display.strftime('%H:%M') == '00:00':
+                 end_time_str = local_end_display.strftime('%H:%M')
+                 if end_time_str == '00:00':
+                     end_time_str = '24:00'
+                 output_lines.append(f"• {start_day_abbr}, {local_start.strftime('%H:%M')} - {end_time_str} ({intensity_description})")
+            else:
+                output_lines.append(f"• {start_day_abbr}, {local_start.strftime('%H:%M')} - {end_day_abbr}, {local_end_display.strftime('%H:%M')} ({intensity_description})")
+        
+        return output_lines
+
+    except Exception as e:
+        wp.logger.error(f"Ошибка при форматировании прогноза: {e}")
+        return ["Прогноз недоступен"]
+
+
+def _sample_frame(width: int, height: int) -> Image.Image:
+    rng = np.random.default_rng(0)
+    return Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+
+
+def _frames_to_array(frames: List[Image.Image]) -> np.ndarray:
+    # Все карточки в одном непрерывном массиве (N, H, W, 3) uint8; размер задаёт первый кадр
+    size = frames[0].size
+    stack = np.empty((len(frames), size[1], size[0], 3), dtype=np.uint8)
+    for i, frame in enumerate(frames):
+        wp.frame_to_array(frame, size, stack[i])
+    return stack
+
+
+def _measure(fn: Callable[[], object], iterations: int) -> float:
+    fn()  # прогрев (кэши, ленивые импорты)
+    start = time.perf_counter()
+    for _ in range(iterations): fn()
+    return iterations / (time.perf_counter() - start)
+
+
+def bench_watermark(width: int, height: int, iterations: int) -> None:
+    frame = _sample_frame(width, height)
+    before = _measure(lambda: np.array(legacy_add_watermark(frame)), iterations)
+    frame_array = np.array(frame)
+    after = _measure(lambda: wp.apply_watermark(frame_array.copy()), iterations)
+    diff = np.abs(np.array(legacy_add_watermark(frame), dtype=np.int16) - wp.apply_watermark(frame_array.copy())).max()
+    print(f"watermark {width}x{height}: до {before:.1f} кадр/с, после {after:.1f} кадр/с "
+          f"(x{after / before:.1f}), макс. расхождение пикселей: {diff}")
+
+
+def bench_transition(width: int, height: int, iterations: int) -> None:
+    steps = 15
+    current, nxt = _sample_frame(width, height), _sample_frame(width, height).transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+
+    def legacy() -> None:
+        for step in range(1, steps + 1):
+            np.array(legacy_add_watermark(Image.blend(current, nxt, alpha=step / steps)))
+
+    stack = _frames_to_array([current, nxt])
+    buffers = wp.allocate_transition_buffers(stack.shape[1:])
+    before = _measure(legacy, max(1, iterations // 20)) * steps
+    for kind in wp.TRANSITION_TYPES:
+        def engine() -> None:
+            for batch in wp.iter_transition_frames(stack[0], stack[1], steps, kind, buffers):
+                wp.apply_watermark(batch)
+        after = _measure(engine, max(1, iterations // 5)) * steps
+        print(f"transition {kind} {width}x{height}: до {before:.1f} кадр/с, после {after:.1f} кадр/с (x{after / before:.1f})")
+    blends = np.concatenate([b.copy() for b in wp.iter_transition_frames(stack[0], stack[1], steps, "crossfade", buffers)])
+    reference = np.stack([np.array(Image.blend(current, nxt, alpha=step / steps)) for step in range(1, steps + 1)])
+    print(f"transition crossfade: макс. расхождение с Image.blend: {np.abs(blends.astype(np.int16) - reference).max()}")
+
+
+def _forecast_batch(cities: int) -> List[Dict]:
+    # Фикстура One Call с перемешанными вероятностями и объёмами осадков — у каждого города свои интервалы
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks", "fixtures", "onecall.json"), encoding="utf-8") as f:
+        base = json.load(f)
+    rng = random.Random(0)
+    batch = []
+    for _ in range(cities):
+        data = copy.deepcopy(base)
+        for hour in data['hourly']:
+            hour['pop'] = rng.choice((0.1, 0.3, 0.5, 0.9))
+            hour['rain'] = {'1h': rng.choice((0, 0.4, 1.5, 4.0))}
+        batch.append(data)
+    return batch
+
+
+def bench_forecast(width: int, height: int, iterations: int) -> None:
+    # Публикация анализирует один пакет из всех городов CITIES; 100 — запас на рост списка
+    for cities in (len(wp.CITIES), 100):
+        batch = _forecast_batch(cities)
+        before = _measure(lambda: [legacy_format_precipitation_forecast(data) for data in batch], max(1, iterations // 4)) * cities
+        after = _measure(lambda: wp.analyze_forecasts(batch), max(1, iterations // 4)) * cities
+        same = all(legacy_format_precipitation_forecast(data) == result['precipitation_lines']
+                   for data, result in zip(batch, wp.analyze_forecasts(batch)))
+        print(f"forecast пакет {cities}: до {before:.0f} город/с (только осадки), после {after:.0f} город/с "
+              f"(осадки + сводка + график, x{after / before:.1f}), совпадение строк: {same}")
+
+
+# Модули, которые weather_publisher раньше импортировал при загрузке (сейчас — лениво, по первому обращению)
+MEDIA_MODULES = ("numpy", "imageio", "PIL.Image", "PIL.ImageDraw", "PIL.ImageFont", "telegram", "telegram.error", "yaml", "httpx")
+
+
+def _import_times_ms(statement: str) -> Dict[str, float]:
+    # Суммарное время импорта (мс) по модулям верхнего уровня из вывода python -X importtime
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], capture_output=True, text=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) != 3 or not parts[1].strip().isdigit(): continue
+        name = parts[2].rstrip()
+        if len(name) - len(name.lstrip()) == 1: times[name.strip()] = int(parts[1]) / 1000
+    return times
+
+
+def bench_startup(width: int, height: int, iterations: int) -> None:
+    runs = max(3, iterations // 40)
+    eager = min((_import_times_ms(f"import {', '.join(MEDIA_MODULES)}, weather_publisher") for _ in range(runs)),
+                key=lambda times: sum(times.values()))
+    lazy = min((_import_times_ms("import weather_publisher") for _ in range(runs)), key=lambda times: sum(times.values()))
+    before, after = sum(eager.values()), sum(lazy.values())
+    print(f"startup (-X importtime): до {before:.0f} мс, после {after:.0f} мс (x{before / after:.1f})")
+    heaviest = sorted(lazy.items(), key=lambda item: item[1], reverse=True)[:5]
+    print("startup: самые тяжёлые импорты сейчас: " + ", ".join(f"{name} {ms:.0f} мс" for name, ms in heaviest))
+
+
+BENCHMARKS = {
+    "watermark": bench_watermark,
+    "transition": bench_transition,
+    "forecast": bench_forecast,
+    "startup": bench_startup,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Микробенчмарки weather_publisher")
+    parser.add_argument("names", nargs="*", help=f"из {', '.join(BENCHMARKS)}; по умолчанию — все")
+    parser.add_argument("--width", type=int, default=800)
+    parser.add_argument("--height", type=int, default=600)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown: parser.error(f"неизвестные бенчмарки: {', '.join(sorted(unknown))}")
+    for name in args.names or list(BENCHMARKS):
+        BENCHMARKS[name](args.width, args.height, args.iterations)
@@ -0,0 +1,248 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from typing import Any, Dict, List
+
+from tests.fakes import FIXTURES_DIR, FakeBot, fixture_transport
+
+try:
+    import resource
+except ImportError:  # Windows: пиковая память не измеряется
+    resource = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+# Базовые линии хранятся в репозитории, по файлу на сценарий; в CI бенчмарк не запускается — сравнение делается вручную.
+# Обновлять после намеренных изменений производительности на той же машине, где потом сравнивают:
+#   python benchmark_pipeline.py --repeat 3 --update-baseline
+# и коммитить изменённый benchmarks/baselines/<сценарий>.json вместе с изменением кода
+BASELINES_DIR = os.path.join(ROOT, "benchmarks", "baselines")
+# Файлы, которые скрипт открывает по относительному пути из рабочей папки
+ASSETS = ("arial.ttf", "DejaVuSans.ttf", "watermark.png", "watermark_1.png")
+# Метрики для сравнения с базовой линией: рост времени/памяти и падение пропускной способности — регрессия.
+# Абсолютный порог отсекает шум на коротких этапах.
+LOWER_IS_BETTER = {"duration_sec": 0.2, "fetch_wall_sec": 0.05, "render_wall_sec": 0.1, "encode_sec": 0.2,
+                   "publish_sec": 0.05, "peak_rss_mb": 20, "children_peak_rss_mb": 20}
+HIGHER_IS_BETTER = ("frames_per_sec", "cards_per_sec")
+
+
+# --- Подмена внешних сервисов (выполняется в дочернем процессе) ---
+def install_fakes(wp, api_latency_sec: float):
+    # Дочерний процесс живёт один прогон, поэтому клиент подменяется во всём модуле; тесты берут транспорт напрямую
+    import httpx
+
+    def create_http_client(max_connections: int = wp.HTTP_MAX_CONCURRENCY, timeout: float = wp.HTTP_TIMEOUT_SEC):
+        return httpx.AsyncClient(transport=fixture_transport(wp, api_latency_sec), timeout=httpx.Timeout(timeout))
+
+    wp.create_http_client = create_http_client
+
+
+def _wall_sec(spans: List[Dict[str, Any]], stage: str) -> float:
+    # Этапы городов идут параллельно: считаем время от начала первого до конца последнего интервала
+    stage_spans = [span for span in spans if span["stage"] == stage]
+    if not stage_spans: return 0.0
+    return max(s["start_sec"] + s["duration_sec"] for s in stage_spans) - min(s["start_sec"] for s in stage_spans)
+
+
+def _max_rss_mb(who: int) -> float:
+    if resource is None: return 0.0
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def run_child(config: Dict[str, Any]) -> Dict[str, Any]:
+    sys.path.insert(0, ROOT)
+    import weather_publisher as wp
+
+    # Города сверх исходных повторяют их координаты и фоны, к имени добавляется номер круга
+    names = list(wp.CITIES.items())
+    wp.CITIES = {}
+    os.mkdir(wp.BACKGROUNDS_FOLDER)
+    for i, (name, coords) in zip(range(config["cities"]), itertools.cycle(names)):
+        city_name = name if i < len(names) else f"{name} {i // len(names) + 1}"
+        wp.CITIES[city_name] = coords
+        os.symlink(os.path.join(ROOT, wp.BACKGROUNDS_FOLDER, name), os.path.join(wp.BACKGROUNDS_FOLDER, city_name))
+    wp.VIDEO_FPS = config["fps"]
+    wp.VIDEO_HOLD_DURATION_SEC = config["hold"]
+    wp.TRANSITION_STEPS = config["steps"]
+    wp.BACKGROUND_TARGET_WIDTH = config["width"]
+    install_fakes(wp, config["api_latency_ms"] / 1000)
+    # Фоны в CI собираются отдельным шагом до запуска — здесь тоже не входят в замер
+    wp.refresh_background_cache(config["width"])
+
+    for _ in range(2 if config["warm"] else 1):
+        asyncio.run(wp.main(bot=FakeBot(os.environ["TELEGRAM_BOT_TOKEN"], config["upload_latency_ms"] / 1000)))
+    report = wp.metrics.report()
+    stages = report["stages"]
+    counters = report["counters"]
+    encode_sec = stages.get("encode", {}).get("total_sec", 0.0)
+    render_wall = _wall_sec(report["spans"], "render")
+    frames = report.get("video", {}).get("frames_written", 0)
+    cards = counters.get("cards_rendered", 0)
+    return {
+        "duration_sec": report["duration_sec"],
+        "fetch_wall_sec": _wall_sec(report["spans"], "fetch"),
+        "render_wall_sec": render_wall,
+        "encode_sec": encode_sec,
+        "publish_sec": stages.get("publish", {}).get("total_sec", 0.0),
+        "frames_written": frames,
+        "frames_per_sec": frames / encode_sec if encode_sec else 0.0,
+        "cards_rendered": cards,
+        "cards_per_sec": cards / render_wall if render_wall else 0.0,
+        "video_bytes": counters.get("bytes_uploaded", 0),
+        "encoding": report.get("video", {}).get("encoding"),
+        "peak_rss_mb": _max_rss_mb(resource.RUSAGE_SELF) if resource else 0.0,
+        # Воркеры рендера и ffmpeg: максимум по завершившимся дочерним процессам
+        "children_peak_rss_mb": _max_rss_mb(resource.RUSAGE_CHILDREN) if resource else 0.0,
+        "stages": stages,
+        "counters": counters,
+    }
+
+
+def record_fixtures(api_key: str):
+    # Перезаписывает фикстуры живыми ответами API для первого города (те же параметры запроса, что у скрипта)
+    import httpx
+    sys.path.insert(0, ROOT)
+    import weather_publisher as wp
+
+    coords = next(iter(wp.CITIES.values()))
+    requests = (("onecall.json", wp.OPENWEATHER_API_URL, {"units": "metric", "lang": "ru", "exclude": "minutely,alerts"}),
+                ("air_pollution.json", wp.AIR_POLLUTION_API_URL, {}))
+    with httpx.Client(timeout=wp.HTTP_TIMEOUT_SEC) as client:
+        for name, url, params in requests:
+            response = client.get(url, params={"lat": coords["lat"], "lon": coords["lon"], "appid": api_key, **params})
+            response.raise_for_status()
+            with open(os.path.join(FIXTURES_DIR, name), "w", encoding="utf-8") as f:
+                json.dump(response.json(), f, ensure_ascii=False, indent=1)
+            print(f"записана фикстура {name}")
+
+
+# --- Запуск сценариев (родительский процесс) ---
+def scenario_name(config: Dict[str, Any]) -> str:
+    name = f"c{config['cities']}_fps{config['fps']}_h{config['hold']:g}_s{config['steps']}_w{config['width']}"
+    if config["profile"] != "balanced": name += f"_{config['profile']}"
+    return name + ("_warm" if config["warm"] else "")
+
+
+def prepare_workdir(workdir: str):
+    # Отдельная рабочая папка на каждый прогон: свои кэши карточек/видео, хранилище сообщений и отчёт
+    for name in ASSETS:
+        if os.path.exists(os.path.join(ROOT, name)): os.symlink(os.path.join(ROOT, name), os.path.join(workdir, name))
+
+
+def run_scenario(config: Dict[str, Any], shared_cache_dir: str, verbose: bool) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory(prefix="weather-bench-") as workdir:
+        prepare_workdir(workdir)
+        env = dict(os.environ, OPENWEATHER_API_KEY="bench", TELEGRAM_BOT_TOKEN="123456:bench",
+                   TARGET_CHAT_ID=",".join(str(-1000 - i) for i in range(config["chats"])),
+                   POST_PUBLISH_DELAY_SEC="0", WEATHER_PROFILE="", VIDEO_ENCODING_PROFILE=config["profile"],
+                   # Фоны и калибровка кодирования общие для всех прогонов: auto учится на предыдущих сценариях
+                   BACKGROUND_CACHE_DIR=os.path.join(shared_cache_dir, "backgrounds"),
+                   ENCODING_CALIBRATION_FILE=os.path.join(shared_cache_dir, "encoding_calibration.json"))
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", json.dumps(config)],
+                              cwd=workdir, env=env, capture_output=True, text=True)
+        if verbose or proc.returncode != 0: sys.stderr.write(proc.stderr)
+        if proc.returncode != 0:
+            raise RuntimeError(f"сценарий {scenario_name(config)} завершился с кодом {proc.returncode}")
+        return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def compare_with_baseline(result: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    regressions = []
+    for key, floor in LOWER_IS_BETTER.items():
+        old, new = baseline.get(key), result.get(key)
+        if old is not None and new is not None and new > old * (1 + tolerance) and new - old > floor:
+            regressions.append(f"{key}: {old:.3f} -> {new:.3f} (+{(new / old - 1) * 100 if old else float('inf'):.0f}%)")
+    for key in HIGHER_IS_BETTER:
+        old, new = baseline.get(key), result.get(key)
+        if old and new is not None and new < old / (1 + tolerance):
+            regressions.append(f"{key}: {old:.2f} -> {new:.2f} (-{(1 - new / old) * 100:.0f}%)")
+    return regressions
+
+
+def print_result(name: str, result: Dict[str, Any]):
+    print(f"{name}: всего {result['duration_sec']:.2f} с | fetch {result['fetch_wall_sec']:.3f} с, "
+          f"render {result['render_wall_sec']:.2f} с ({result['cards_per_sec']:.1f} карт./с), "
+          f"encode {result['encode_sec']:.2f} с ({result['frames_per_sec']:.1f} кадр/с, кадров {result['frames_written']:.0f}), "
+          f"publish {result['publish_sec']:.3f} с | видео {result['video_bytes'] / 1024:.0f} КБ"
+          f"{' (' + result['encoding']['preset'] + '/CRF ' + str(result['encoding']['crf']) + ')' if result.get('encoding') else ''} | "
+          f"RSS {result['peak_rss_mb']:.0f} МБ, дочерние {result['children_peak_rss_mb']:.0f} МБ")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Сквозной бенчмарк конвейера на записанных ответах API и фиктивном Telegram-боте. "
+                    "Для списков значений прогоняются все комбинации. Сценарии с базовой линией в benchmarks/baselines "
+                    "сравниваются с ней, обновление: --repeat 3 --update-baseline на той же машине.")
+    parser.add_argument("--cities", type=int, nargs="+", default=[3])
+    parser.add_argument("--fps", type=int, nargs="+", default=[20])
+    parser.add_argument("--hold", type=float, nargs="+", default=[5], help="длительность показа карточки, с")
+    parser.add_argument("--steps", type=int, nargs="+", default=[15], help="кадров перехода")
+    parser.add_argument("--width", type=int, nargs="+", default=[800], help="ширина карточки/видео")
+    parser.add_argument("--profile", nargs="+", default=["balanced"], help="профили кодирования: fast, balanced, small, auto")
+    parser.add_argument("--chats", type=int, default=1)
+    parser.add_argument("--warm", action="store_true", help="замерить повторный запуск с прогретыми кэшами")
+    parser.add_argument("--api-latency-ms", type=float, default=0.0, help="искусственная задержка ответа API")
+    parser.add_argument("--upload-latency-ms", type=float, default=0.0, help="искусственная задержка загрузки видео")
+    parser.add_argument("--repeat", type=int, default=1, help="прогонов на сценарий, берётся самый быстрый")
+    parser.add_argument("--update-baseline", action="store_true", help=f"записать результаты как базовые в {BASELINES_DIR}")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="допустимое ухудшение относительно базовой линии")
+    parser.add_argument("--output", help="сохранить все результаты в JSON")
+    parser.add_argument("--record", action="store_true", help="обновить фикстуры живыми ответами API (нужен OPENWEATHER_API_KEY)")
+    parser.add_argument("--verbose", action="store_true", help="показывать логи дочерних прогонов")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_child(json.loads(args.child))))
+        return 0
+    if args.record:
+        api_key = os.getenv("OPENWEATHER_API_KEY")
+        if not api_key: parser.error("для --record нужен OPENWEATHER_API_KEY")
+        record_fixtures(api_key)
+        return 0
+
+    results: Dict[str, Any] = {}
+    failed = False
+    with tempfile.TemporaryDirectory(prefix="weather-bench-shared-") as shared_cache_dir:
+        for cities, fps, hold, steps, width, profile in itertools.product(args.cities, args.fps, args.hold, args.steps, args.width, args.profile):
+            config = {"cities": cities, "fps": fps, "hold": hold, "steps": steps, "width": width, "profile": profile, "chats": args.chats,
+                      "warm": args.warm, "api_latency_ms": args.api_latency_ms, "upload_latency_ms": args.upload_latency_ms}
+            name = scenario_name(config)
+            runs = [run_scenario(config, shared_cache_dir, args.verbose) for _ in range(max(1, args.repeat))]
+            result = min(runs, key=lambda r: r["duration_sec"])
+            results[name] = {"config": config, **result}
+            print_result(name, result)
+
+            baseline_path = os.path.join(BASELINES_DIR, f"{name}.json")
+            if args.update_baseline:
+                os.makedirs(BASELINES_DIR, exist_ok=True)
+                with open(baseline_path, "w", encoding="utf-8") as f:
+                    json.dump({"python": platform.python_version(), "machine": platform.machine(),
+                               "cpu_count": os.cpu_count(), **results[name]}, f, ensure_ascii=False, indent=1)
+                print(f"  базовая линия записана: {os.path.relpath(baseline_path, ROOT)}")
+            elif os.path.exists(baseline_path):
+                with open(baseline_path, encoding="utf-8") as f:
+                    baseline = json.load(f)
+                if baseline.get("cpu_count") != os.cpu_count() or baseline.get("machine") != platform.machine():
+                    print("  внимание: базовая линия снята на другой машине, сравнение ориентировочное")
+                regressions = compare_with_baseline(result, baseline, args.tolerance)
+                for line in regressions: print(f"  РЕГРЕССИЯ {line}")
+                if not regressions: print(f"  в пределах {args.tolerance:.0%} от базовой линии")
+                failed = failed or bool(regressions)
+            else:
+                print("  базовой линии для сценария нет, сравнение пропущено")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import weather_publisher  # noqa: E402
+
+
+@pytest.fixture
+def wp(tmp_path, monkeypatch):
+    # Каждый тест — в своей рабочей папке: хранилище сообщений, кэши и отчёты не попадают в репозиторий
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(weather_publisher, "API_CACHE_DIR", str(tmp_path / "api"))
+    monkeypatch.setattr(weather_publisher, "MESSAGE_STORE_FILE", str(tmp_path / "message_ids.sqlite3"))
+    monkeypatch.setattr(weather_publisher, "MESSAGE_IDS_FILE", str(tmp_path / "message_ids.yml"))
+    monkeypatch.setattr(weather_publisher, "circuit_breakers", {})
+    weather_publisher.metrics.reset()
+    return weather_publisher
@@ -0,0 +1,53 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_DIR = os.path.join(ROOT, "benchmarks", "fixtures")
+
+
+# Двойники внешних сервисов для тестов и benchmark_pipeline.py; модуль weather_publisher они не изменяют
+class FakeBot:
+    # Минимальный двойник telegram.Bot: «загрузка» читает файл целиком, ответы похожи на настоящие сообщения
+    def __init__(self, token: str, upload_latency_sec: float = 0.0):
+        self.token = token
+        self.upload_latency_sec = upload_latency_sec
+        self.next_message_id = 1000
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return None
+
+    async def send_animation(self, chat_id, animation, **kwargs):
+        if hasattr(animation, "read"):
+            animation.read()
+            await asyncio.sleep(self.upload_latency_sec)
+            file_id = "bench-file-id"
+        else:
+            file_id = animation
+        self.next_message_id += 1
+        return SimpleNamespace(message_id=self.next_message_id, chat_id=chat_id,
+                               animation=SimpleNamespace(file_id=file_id), document=None, video=None)
+
+    async def delete_messages(self, chat_id, message_ids, **kwargs):
+        return True
+
+
+def fixture_transport(wp, api_latency_sec: float = 0.0):
+    # Отвечает записанными ответами One Call и Air Pollution на запросы с любыми координатами (URL без query)
+    import httpx
+
+    payloads = {}
+    for url, name in ((wp.OPENWEATHER_API_URL, "onecall.json"), (wp.AIR_POLLUTION_API_URL, "air_pollution.json")):
+        with open(os.path.join(FIXTURES_DIR, name), "rb") as f:
+            payloads[url] = f.read()
+
+    async def replay(request: "httpx.Request") -> "httpx.Response":
+        await asyncio.sleep(api_latency_sec)
+        payload = payloads.get(str(request.url.copy_with(query=None)))
+        if payload is None: return httpx.Response(404)
+        return httpx.Response(200, content=payload, headers={"Content-Type": "application/json"})
+
+    return httpx.MockTransport(replay)
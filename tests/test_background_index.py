@@ -0,0 +1,32 @@
+import json
+import os
+
+from tests.fakes import FIXTURES_DIR
+
+CITIES = ("Пномпень", "Сиемреап")
+
+
+def test_card_specs_share_one_index_and_workers_reuse_hashes(wp, monkeypatch):
+    for city_name in CITIES:
+        os.makedirs(os.path.join(wp.BACKGROUNDS_FOLDER, city_name))
+        with open(os.path.join(wp.BACKGROUNDS_FOLDER, city_name, "a.jpg"), "wb") as f:
+            f.write(city_name.encode())
+    with open(os.path.join(FIXTURES_DIR, "onecall.json"), encoding="utf-8") as f:
+        weather_data = json.load(f)
+
+    hashed, loads = [], []
+    file_content_hash, load_background_index = wp.file_content_hash, wp.load_background_index
+    monkeypatch.setattr(wp, "file_content_hash", lambda path: hashed.append(path) or file_content_hash(path))
+    monkeypatch.setattr(wp, "load_background_index", lambda: loads.append(1) or load_background_index())
+
+    index = wp.load_background_index()
+    forecasts = wp.analyze_forecasts([weather_data] * len(CITIES))
+    specs = [wp.weather_card_spec(city_name, weather_data, forecast['precipitation_lines'], None, forecast, index)
+             for city_name, forecast in zip(CITIES, forecasts)]
+    assert len(loads) == 1 and len(hashed) == len(CITIES)
+    wp.update_background_index(index)
+
+    # Воркер рендера находит хэш в сохранённом индексе и не читает фото заново
+    for spec in specs:
+        assert wp.get_background_hash(spec['background_path'], wp.load_background_index()) == spec['background_sha256']
+    assert len(hashed) == len(CITIES)
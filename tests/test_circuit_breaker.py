@@ -0,0 +1,105 @@
+import asyncio
+
+import httpx
+import pytest
+
+
+@pytest.fixture
+def clock(wp, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(wp.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_opens_after_threshold(wp, clock):
+    breaker = wp.CircuitBreaker("onecall", failure_threshold=3, reset_timeout_sec=60)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert not breaker.allow()
+
+
+def test_success_resets_failure_count(wp, clock):
+    breaker = wp.CircuitBreaker("onecall", failure_threshold=2, reset_timeout_sec=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.allow()
+
+
+def test_half_open_allows_single_trial(wp, clock):
+    breaker = wp.CircuitBreaker("onecall", failure_threshold=1, reset_timeout_sec=60)
+    breaker.record_failure()
+    clock[0] += 59
+    assert not breaker.allow()
+    clock[0] += 1
+    assert breaker.allow()
+    # Пока пробный запрос не завершился, остальные не пропускаются
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.allow() and breaker.allow()
+
+
+def test_failed_trial_reopens_for_full_timeout(wp, clock):
+    breaker = wp.CircuitBreaker("onecall", failure_threshold=1, reset_timeout_sec=60)
+    breaker.record_failure()
+    clock[0] += 60
+    assert breaker.allow()
+    breaker.record_failure()
+    clock[0] += 59
+    assert not breaker.allow()
+    clock[0] += 1
+    assert breaker.allow()
+
+
+def test_get_json_skips_open_endpoint(wp, monkeypatch):
+    monkeypatch.setattr(wp, "HTTP_RETRIES", 3)
+    monkeypatch.setattr(wp, "HTTP_BACKOFF_BASE_SEC", 0)
+    wp.circuit_breakers["onecall"] = wp.CircuitBreaker("onecall", failure_threshold=2, reset_timeout_sec=60)
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(503)
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await wp._get_json("https://api.test/onecall", {}, client, "onecall")
+
+    # Две ошибки открывают автомат — третья попытка уже не уходит в сеть
+    with pytest.raises(wp.CircuitOpenError):
+        asyncio.run(run())
+    assert len(requests) == 2
+    assert wp.metrics.counters["circuit_open_skips"] == 1
+
+    # Открытый автомат не мешает отдать последний удачный ответ
+    coords = {"lat": 1, "lon": 2}
+    wp.save_last_good_response("onecall", coords, {"current": {}})
+
+    async def run_with_fallback():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await wp.get_current_weather(coords, "key", client)
+
+    assert asyncio.run(run_with_fallback())["current"] == {}
+    assert len(requests) == 2
+
+
+@pytest.mark.parametrize("failure", ["error", "cancel"])
+def test_unexpected_failure_releases_half_open_trial(wp, failure):
+    breaker = wp.circuit_breakers["onecall"] = wp.CircuitBreaker("onecall", failure_threshold=1, reset_timeout_sec=0)
+    breaker.record_failure()
+
+    async def handler(request):
+        if failure == "error": raise RuntimeError("stream consumed")
+        await asyncio.sleep(5)
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            await asyncio.wait_for(wp._get_json("https://api.test/onecall", {}, client, "onecall"), 0.05)
+
+    with pytest.raises((RuntimeError, asyncio.TimeoutError)):
+        asyncio.run(run())
+    # Неудачная проба снова открыла автомат, но следующая проба (reset_timeout_sec=0) разрешена
+    assert not breaker.trial_in_flight and breaker.opened_at is not None
+    assert breaker.allow()
@@ -0,0 +1,76 @@
+import datetime
+
+import pytest
+
+
+def utc(*args):
+    return datetime.datetime(*args, tzinfo=datetime.timezone.utc)
+
+
+def test_default_schedule(wp):
+    schedule = wp.CronSchedule(wp.SERVE_SCHEDULE)
+    assert schedule.next_after(utc(2026, 3, 1, 0, 0)) == utc(2026, 3, 1, 1, 50)
+    assert schedule.next_after(utc(2026, 3, 1, 1, 50)) == utc(2026, 3, 1, 4, 50)
+    # После 22:50 — следующий день
+    assert schedule.next_after(utc(2026, 3, 1, 22, 50)) == utc(2026, 3, 2, 1, 50)
+
+
+def test_next_after_is_strict_and_drops_seconds(wp):
+    schedule = wp.CronSchedule("*/15 * * * *")
+    assert schedule.next_after(utc(2026, 3, 1, 10, 15)) == utc(2026, 3, 1, 10, 30)
+    assert schedule.next_after(utc(2026, 3, 1, 10, 14, 59, 999)) == utc(2026, 3, 1, 10, 15)
+
+
+def test_next_after_converts_to_utc(wp):
+    schedule = wp.CronSchedule("0 12 * * *")
+    phnom_penh = datetime.timezone(datetime.timedelta(hours=7))
+    # 18:30 в Пномпене — 11:30 UTC, до полудня по UTC ещё полчаса
+    assert schedule.next_after(datetime.datetime(2026, 3, 1, 18, 30, tzinfo=phnom_penh)) == utc(2026, 3, 1, 12, 0)
+    assert schedule.next_after(datetime.datetime(2026, 3, 1, 19, 30, tzinfo=phnom_penh)) == utc(2026, 3, 2, 12, 0)
+
+
+def test_lists_ranges_and_steps(wp):
+    schedule = wp.CronSchedule("5,35 8-10/2 * * *")
+    assert schedule.minutes == {5, 35}
+    assert schedule.hours == {8, 10}
+    assert wp.CronSchedule("10/20 * * * *").minutes == {10, 30, 50}
+
+
+def test_month_rollover(wp):
+    schedule = wp.CronSchedule("0 0 1 2 *")
+    assert schedule.next_after(utc(2026, 2, 1, 0, 0)) == utc(2027, 2, 1, 0, 0)
+    assert wp.CronSchedule("0 0 29 2 *").next_after(utc(2026, 1, 1)) == utc(2028, 2, 29, 0, 0)
+
+
+def test_day_of_month_or_day_of_week(wp):
+    # 2026-03-01 — воскресенье: при заданных обоих полях срабатывает 13-е число ИЛИ пятница
+    either = wp.CronSchedule("0 9 13 * 5")
+    assert either.next_after(utc(2026, 3, 1)) == utc(2026, 3, 6, 9, 0)
+    assert either.next_after(utc(2026, 3, 10)) == utc(2026, 3, 13, 9, 0)
+    # Если одно из полей — *, нужно совпадение второго
+    assert wp.CronSchedule("0 9 * * 5").next_after(utc(2026, 3, 7)) == utc(2026, 3, 13, 9, 0)
+    assert wp.CronSchedule("0 9 13 * *").next_after(utc(2026, 3, 14)) == utc(2026, 4, 13, 9, 0)
+    # 0 и 7 — воскресенье
+    assert wp.CronSchedule("0 9 * * 7").next_after(utc(2026, 3, 2)) == utc(2026, 3, 8, 9, 0)
+
+
+@pytest.mark.parametrize("expression", ["* * * *", "60 * * * *", "* 24 * * *", "0 0 0 * *", "* * * 13 *",
+                                        "5-1 * * * *", "*/0 * * * *", "a * * * *"])
+def test_invalid_expressions(wp, expression):
+    with pytest.raises(ValueError):
+        wp.CronSchedule(expression)
+
+
+def test_impossible_date_never_fires(wp):
+    with pytest.raises(ValueError):
+        wp.CronSchedule("0 0 31 2 *").next_after(utc(2026, 1, 1))
+
+
+def test_first_due_time_catches_up_recent_slot(wp, monkeypatch):
+    monkeypatch.setattr(wp, "SERVE_CATCH_UP_MINUTES", 30)
+    schedule = wp.CronSchedule("50 22,1,4,7,10,13,16 * * *")
+    state = {"last_slot": utc(2026, 3, 1, 1, 50).isoformat()}
+    assert wp.first_due_time(schedule, state, utc(2026, 3, 1, 5, 10)) == utc(2026, 3, 1, 4, 50)
+    # Опоздание больше SERVE_CATCH_UP_MINUTES — ждём следующего слота
+    assert wp.first_due_time(schedule, state, utc(2026, 3, 1, 5, 30)) == utc(2026, 3, 1, 7, 50)
+    assert wp.first_due_time(schedule, {}, utc(2026, 3, 1, 5, 10)) == utc(2026, 3, 1, 7, 50)
@@ -0,0 +1,83 @@
+import asyncio
+import datetime
+
+import pytest
+from telegram.error import BadRequest, RetryAfter
+
+from tests.fakes import FakeBot
+
+
+class DeletingBot(FakeBot):
+    # Двойник бота для удаления: записывает вызовы и по очереди выдаёт заготовленные ошибки
+    def __init__(self, errors=()):
+        super().__init__("123456:test")
+        self.calls = []
+        self.errors = list(errors)
+
+    async def delete_messages(self, chat_id, message_ids, **kwargs):
+        self.calls.append((chat_id, list(message_ids)))
+        if self.errors:
+            error = self.errors.pop(0)
+            if error is not None: raise error
+        return True
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+
+    async def fake_sleep(delay, *args, **kwargs):
+        delays.append(delay)
+
+    monkeypatch.setattr(asyncio, "sleep", fake_sleep)
+    return delays
+
+
+def test_batches_of_100(wp):
+    bot = DeletingBot()
+    failed = asyncio.run(wp.delete_chat_messages(bot, "-100", list(range(1, 251))))
+    assert failed == []
+    assert [len(ids) for _, ids in bot.calls] == [100, 100, 50]
+    assert [ids[0] for _, ids in bot.calls] == [1, 101, 201]
+
+
+def test_retry_after_waits_exactly_and_retries_same_batch(wp, sleeps):
+    bot = DeletingBot(errors=[RetryAfter(3), RetryAfter(datetime.timedelta(seconds=1.5))])
+    failed = asyncio.run(wp.delete_chat_messages(bot, "-100", [1, 2, 3]))
+    assert failed == []
+    assert sleeps == [3.0, 1.5]
+    assert bot.calls == [("-100", [1, 2, 3])] * 3
+
+
+def test_retry_after_gives_up_after_retries(wp, sleeps):
+    bot = DeletingBot(errors=[RetryAfter(1)] * (wp.TELEGRAM_FLOOD_RETRIES + 1))
+    assert asyncio.run(wp.delete_chat_messages(bot, "-100", [1, 2])) == [1, 2]
+    assert len(sleeps) == wp.TELEGRAM_FLOOD_RETRIES
+
+
+def test_bad_request_fallback(wp):
+    # «Уже удалено» — забываем ID; прочие ошибки — оставляем пачку для следующей попытки
+    bot = DeletingBot(errors=[BadRequest("Message to delete not found"), BadRequest("Chat not found"), RuntimeError("boom")])
+    failed = asyncio.run(wp.delete_chat_messages(bot, "-100", list(range(300))))
+    assert failed == list(range(100, 300))
+
+
+def test_delete_old_messages_keeps_failed_ids_per_chat(wp):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    with wp.open_message_store() as store:
+        store.add("-1", 10, now)
+        store.add("-2", 20, now)
+        store.add("", 30, now)  # запись старого формата — относится к текущему чату
+        store.add("-1", 40, now - datetime.timedelta(hours=wp.TELEGRAM_DELETE_WINDOW_HOURS + 1))
+
+    class FailingChatBot(DeletingBot):
+        async def delete_messages(self, chat_id, message_ids, **kwargs):
+            await super().delete_messages(chat_id, message_ids)
+            if chat_id == "-2": raise BadRequest("Not enough rights to delete a message")
+            return True
+
+    bot = FailingChatBot()
+    asyncio.run(wp.delete_old_messages(bot, "-1"))
+    assert sorted((chat, sorted(ids)) for chat, ids in bot.calls) == [("-1", [10, 30]), ("-2", [20])]
+    with wp.open_message_store() as store:
+        assert [(chat, message_id) for chat, message_id, _ in store.messages()] == [("-2", 20)]
@@ -0,0 +1,50 @@
+import json
+import os
+
+import pytest
+
+SIZE = (64, 48)
+STATS = {'frames_written': 40, 'duration_sec': 10.0, 'output_bytes': 200_000, 'encode_sec': 2.0}
+
+
+@pytest.fixture
+def calibration_file(wp, tmp_path, monkeypatch):
+    path = tmp_path / "encoding_calibration.json"
+    monkeypatch.setattr(wp, "ENCODING_CALIBRATION_FILE", str(path))
+    return path
+
+
+@pytest.mark.parametrize("content", ["[]", '{"64x48": []}', '{"64x48": {"medium/28": {"sec_per_frame": 0.01}}}',
+                                     '{"64x48": {"medium/28": {"bytes_per_sec": "fast", "sec_per_frame": 0.01, "runs": 1}}}',
+                                     '{"64x48": {"turbo/x": {"bytes_per_sec": 1000, "sec_per_frame": 0.01, "runs": 1}}}'])
+def test_broken_table_falls_back_to_balanced(wp, calibration_file, content):
+    calibration_file.write_text(content, encoding="utf-8")
+    settings = wp.choose_encoding_settings("auto", SIZE, 10.0, 40)
+    assert (settings['preset'], settings['crf']) == (wp.ENCODING_PROFILES['balanced']['preset'], wp.ENCODING_PROFILES['balanced']['crf'])
+
+    # Запись замера поверх повреждённой таблицы заменяет её корректной
+    wp.record_encoding_calibration(SIZE, {'preset': 'medium', 'crf': 28}, STATS)
+    entry = json.loads(calibration_file.read_text(encoding="utf-8"))["64x48"]["medium/28"]
+    assert entry['runs'] == 1 and entry['bytes_per_sec'] == 20_000
+
+
+def test_valid_entries_survive_next_to_broken_ones(wp, calibration_file):
+    calibration_file.write_text(json.dumps({"64x48": {"medium/28": {"bytes_per_sec": 20_000, "sec_per_frame": 0.05},
+                                                      "slow/28": None}}), encoding="utf-8")
+    assert wp.load_encoding_calibration() == {"64x48": {"medium/28": {"bytes_per_sec": 20_000, "sec_per_frame": 0.05, "runs": 1}}}
+    assert wp.choose_encoding_settings("auto", SIZE, 10.0, 40)['profile'] == "auto"
+
+
+def test_calibration_failure_keeps_video(wp, calibration_file, monkeypatch):
+    Image = pytest.importorskip("PIL.Image")
+    pytest.importorskip("imageio_ffmpeg")
+
+    def broken(*args, **kwargs):
+        raise RuntimeError("calibration is broken")
+
+    monkeypatch.setattr(wp, "record_encoding_calibration", broken)
+    monkeypatch.setattr(wp, "VIDEO_HOLD_DURATION_SEC", 1)
+    monkeypatch.setattr(wp, "TRANSITION_STEPS", 2)
+    cards = [Image.new("RGB", SIZE, color) for color in ("red", "blue")]
+    output_path = wp.create_weather_video(cards, "out.mp4", profile="fast", expected_cards=2)
+    assert output_path == "out.mp4" and os.path.getsize(output_path) > 0
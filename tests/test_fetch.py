@@ -0,0 +1,19 @@
+import asyncio
+
+import httpx
+
+from tests.fakes import fixture_transport
+
+COORDS = {"lat": 11.55, "lon": 104.92}
+
+
+def test_fetch_city_with_benchmark_fixtures(wp):
+    async def run():
+        async with httpx.AsyncClient(transport=fixture_transport(wp)) as client:
+            return await wp.fetch_city(COORDS, "key", client, asyncio.Semaphore(2), city_name="Пномпень")
+
+    weather, aqi = asyncio.run(run())
+    assert "current" in weather and "stale_since" not in weather
+    assert aqi == (2, 14.62)
+    assert sorted(span["endpoint"] for span in wp.metrics.spans if span["stage"] == "fetch") == ["air_pollution", "onecall"]
+    assert wp.load_last_good_response("onecall", COORDS)[0] == weather
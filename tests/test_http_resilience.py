@@ -0,0 +1,124 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+COORDS = {"lat": 11.55, "lon": 104.92}
+
+
+def mock_client(handler):
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def json_response(data, status_code=200):
+    return httpx.Response(status_code, json=data)
+
+
+@pytest.fixture
+def fast_retries(wp, monkeypatch):
+    monkeypatch.setattr(wp, "HTTP_BACKOFF_BASE_SEC", 0)
+    monkeypatch.setattr(wp, "HTTP_RETRIES", 2)
+
+
+def test_retries_server_errors(wp, fast_retries):
+    statuses = iter([503, 429, 200])
+
+    def handler(request):
+        status = next(statuses)
+        return json_response({"ok": status == 200}, status)
+
+    async def run():
+        async with mock_client(handler) as client:
+            return await wp._get_json("https://api.test/onecall", {}, client, "onecall")
+
+    assert asyncio.run(run()) == {"ok": True}
+    assert wp.metrics.counters["http_retries"] == 2
+
+
+def test_client_errors_are_not_retried(wp, fast_retries):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return json_response({}, 401)
+
+    async def run():
+        async with mock_client(handler) as client:
+            return await wp._get_json("https://api.test/onecall", {}, client, "onecall")
+
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(run())
+    assert len(requests) == 1
+    assert wp.get_circuit_breaker("onecall").failures == 0
+
+
+def test_hedged_request_wins_over_slow_one(wp, monkeypatch):
+    monkeypatch.setattr(wp, "HTTP_HEDGE_AFTER_SEC", 0.05)
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        if len(calls) == 1: await asyncio.sleep(5)
+        return json_response({"attempt": len(calls)})
+
+    async def run():
+        async with mock_client(handler) as client:
+            return await wp._get_json("https://api.test/onecall", {}, client, "onecall")
+
+    started = time.perf_counter()
+    assert asyncio.run(run()) == {"attempt": 2}
+    assert time.perf_counter() - started < 1
+    assert wp.metrics.counters["http_hedged_requests"] == 1
+
+
+def test_backoff_does_not_hold_semaphore(wp, monkeypatch):
+    # Пока запрос к сбойному эндпоинту ждёт повтора, единственный слот семафора свободен для других запросов
+    monkeypatch.setattr(wp, "HTTP_RETRIES", 1)
+    monkeypatch.setattr(wp, "HTTP_BACKOFF_BASE_SEC", 0.2)
+    monkeypatch.setattr(wp.random, "uniform", lambda low, high: high)
+    finished = []
+
+    def handler(request):
+        if request.url.path == "/failing": return json_response({}, 503)
+        return json_response({})
+
+    async def fetch(path, client, semaphore):
+        try:
+            await wp._get_json(f"https://api.test{path}", {}, client, path, semaphore)
+        except httpx.HTTPStatusError:
+            pass
+        finished.append(path)
+
+    async def run():
+        semaphore = asyncio.Semaphore(1)
+        async with mock_client(handler) as client:
+            await asyncio.gather(fetch("/failing", client, semaphore), fetch("/healthy", client, semaphore))
+
+    asyncio.run(run())
+    assert finished == ["/healthy", "/failing"]
+
+
+def test_stale_fallback_after_failures(wp, fast_retries):
+    wp.save_last_good_response("onecall", COORDS, {"current": {"temp": 30}})
+    saved_at = wp.load_last_good_response("onecall", COORDS)[1]
+    wp.metrics.reset()
+
+    async def run():
+        async with mock_client(lambda request: json_response({}, 500)) as client:
+            return await wp.get_current_weather(COORDS, "key", client)
+
+    weather = asyncio.run(run())
+    assert weather == {"current": {"temp": 30}, "stale_since": saved_at}
+    assert wp.metrics.counters["stale_fallbacks"] == 1
+
+
+def test_stale_fallback_respects_max_age(wp, fast_retries, monkeypatch):
+    wp.save_last_good_response("onecall", COORDS, {"current": {"temp": 30}})
+    monkeypatch.setattr(wp, "API_LAST_GOOD_MAX_AGE_HOURS", 0)
+
+    async def run():
+        async with mock_client(lambda request: httpx.Response(200, content=b"not json")) as client:
+            return await wp.get_current_weather(COORDS, "key", client)
+
+    assert asyncio.run(run()) is None
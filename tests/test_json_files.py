@@ -0,0 +1,37 @@
+import os
+
+import pytest
+
+
+def test_write_and_read_roundtrip(wp, tmp_path):
+    path = str(tmp_path / "nested" / "state.json")
+    wp.write_json_atomic(path, {"a": [1, 2]}, indent=1)
+    assert wp.read_json(path, {}) == {"a": [1, 2]}
+    assert os.listdir(tmp_path / "nested") == ["state.json"]
+
+
+def test_failed_write_keeps_old_file_and_removes_temp(wp, tmp_path):
+    path = str(tmp_path / "state.json")
+    wp.write_json_atomic(path, {"old": True})
+    with pytest.raises(TypeError):
+        wp.write_json_atomic(path, {"bad": object()})
+    assert wp.read_json(path, {}) == {"old": True}
+    assert os.listdir(tmp_path) == ["state.json"]
+
+
+@pytest.mark.parametrize("content", ["", "{broken", "[]", "42"])
+def test_read_json_falls_back_to_default(wp, tmp_path, content):
+    path = tmp_path / "state.json"
+    path.write_text(content, encoding="utf-8")
+    assert wp.read_json(str(path), {}) == {}
+    assert wp.read_json(str(tmp_path / "missing.json"), None) is None
+
+
+def test_loaders_drop_malformed_entries(wp, tmp_path, monkeypatch):
+    monkeypatch.setattr(wp, "TELEGRAM_FILE_ID_CACHE_FILE", str(tmp_path / "file_ids.json"))
+    wp.write_json_atomic(wp.TELEGRAM_FILE_ID_CACHE_FILE, {"ok": {"file_id": "abc", "saved_at": 1}, "list": [], "no_id": {"saved_at": 2}})
+    assert wp.load_file_id_cache() == {"ok": {"file_id": "abc", "saved_at": 1}}
+
+    coords = {"lat": 1, "lon": 2}
+    wp.write_json_atomic(wp._last_good_path("onecall", coords), {"fetched_at": "yesterday", "data": {}})
+    assert wp.load_last_good_response("onecall", coords) is None
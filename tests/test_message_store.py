@@ -0,0 +1,65 @@
+import datetime
+import os
+
+import pytest
+
+SENT_AT = "2026-08-22T17:01:43.667769+00:00"
+
+
+def write_legacy(wp, text):
+    with open(wp.MESSAGE_IDS_FILE, "w", encoding="utf-8") as f:
+        f.write(text)
+
+
+def stored(store):
+    return [(chat_id, message_id) for chat_id, message_id, _ in store.messages()]
+
+
+def test_migrates_legacy_yaml_into_sqlite(wp):
+    write_legacy(wp, f"- message_id: 10\n  sent_at: '{SENT_AT}'\n  chat_id: '-100'\n- message_id: 11\n  sent_at: '{SENT_AT}'\n")
+    with wp.open_message_store() as store:
+        assert isinstance(store, wp.SqliteMessageStore)
+        # Запись без chat_id (старый формат) хранится с пустым чатом — delete_old_messages отнесёт её к текущему
+        assert stored(store) == [("", 11), ("-100", 10)]
+        assert store.messages("-100")[0][2] == datetime.datetime.fromisoformat(SENT_AT)
+    assert not os.path.exists(wp.MESSAGE_IDS_FILE)
+    with wp.open_message_store() as store:
+        assert stored(store) == [("", 11), ("-100", 10)]
+
+
+@pytest.mark.parametrize("content", ["- message_id: [unclosed\n", "message_id: 10\n"])
+def test_unreadable_legacy_file_is_quarantined(wp, content):
+    write_legacy(wp, content)
+    with wp.open_message_store() as store:
+        assert stored(store) == []
+    assert not os.path.exists(wp.MESSAGE_IDS_FILE)
+    with open(f"{wp.MESSAGE_IDS_FILE}.bak", encoding="utf-8") as f:
+        assert f.read() == content
+
+
+def test_bad_entries_are_skipped(wp):
+    write_legacy(wp, "- message_id: abc\n- message_id: null\n- sent_at: x\n- just text\n- message_id: 0\n"
+                     "- message_id: '12'\n  sent_at: '2026-08-22 17:00:00'\n")
+    with wp.open_message_store() as store:
+        assert stored(store) == [("", 12)]
+        # Время без часового пояса считается UTC
+        assert store.messages()[0][2] == datetime.datetime(2026, 8, 22, 17, tzinfo=datetime.timezone.utc)
+    assert not os.path.exists(wp.MESSAGE_IDS_FILE)
+
+
+def test_duplicates_are_stored_once(wp):
+    with wp.open_message_store() as store:
+        assert store.add("-100", 10, None)
+    write_legacy(wp, "- message_id: 10\n  chat_id: '-100'\n- message_id: 10\n  chat_id: '-100'\n- message_id: 10\n")
+    with wp.open_message_store() as store:
+        assert stored(store) == [("", 10), ("-100", 10)]
+        assert not store.add("-100", 10, None)
+
+
+def test_yaml_backend_skips_bad_entries(wp, monkeypatch):
+    monkeypatch.setattr(wp, "MESSAGE_STORE_BACKEND", "yaml")
+    write_legacy(wp, "- message_id: abc\n- message_id: 5\n  chat_id: '-1'\n")
+    with wp.open_message_store() as store:
+        assert isinstance(store, wp.YamlMessageStore)
+        assert stored(store) == [("-1", 5)]
+        assert store.remove_older_than(datetime.datetime.now(datetime.timezone.utc)) == []
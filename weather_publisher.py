@@ -1,24 +1,167 @@
+from __future__ import annotations
 import logging
-import requests
 import asyncio
+import collections
+import itertools
 import os
+import abc
 import datetime
-from typing import Dict, Any, List, Optional, Tuple
-from PIL import Image, ImageDraw, ImageFont
-from telegram import Bot, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.error import BadRequest
-import yaml
-import imageio
-import numpy as np
+import shutil
+import concurrent.futures
+import contextlib
+import hashlib
+import importlib.util
+import json
+import queue
+import random
+import re
+import signal
+import sqlite3
+import threading
+import time
+from typing import Dict, Any, Iterable, Iterator, List, Optional, Tuple
+
+# --- Ленивые импорты ---
+class LazyModule:
+    # Модуль импортируется при первом обращении к атрибуту: запуск без медиа-стека (--check, ранний выход
+    # из-за отсутствующих переменных окружения) не тратит время на numpy, imageio, Pillow и telegram
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if self._module is None: self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+httpx = LazyModule("httpx")
+np = LazyModule("numpy")
+imageio = LazyModule("imageio")
+yaml = LazyModule("yaml")
+Image = LazyModule("PIL.Image")
+ImageDraw = LazyModule("PIL.ImageDraw")
+ImageFont = LazyModule("PIL.ImageFont")
+telegram = LazyModule("telegram")
+telegram_error = LazyModule("telegram.error")
 
 # --- Базовые настройки ---
 font_cache: Dict[int, ImageFont.FreeTypeFont] = {}
+# Ширины слов по шрифтам (объект шрифта из font_cache -> слово -> ширина) и маски плашек по размеру
+word_width_cache: Dict[ImageFont.FreeTypeFont, Dict[str, float]] = {}
+plaque_mask_cache: Dict[Tuple[int, int, int, int], Image.Image] = {}
+# Кэш вотермарки по размеру кадра (ширина, высота): (y, x, премультиплицированный RGB, 255 - альфа) или None
+watermark_cache: Dict[Tuple[int, int], Optional[Tuple[int, int, np.ndarray, np.ndarray]]] = {}
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
+# httpx логирует каждый запрос вместе с URL (в нём appid и токен бота) — оставляем только предупреждения
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# --- JSON-файлы кэшей и состояния ---
+def write_json_atomic(path: str, data: Any, **dump_kwargs):
+    # Запись во временный файл и os.replace: читатель видит либо старую версию, либо новую целиком.
+    # Если запись не удалась (нет места, данные не сериализуются), временный файл удаляется
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, **dump_kwargs)
+        os.replace(tmp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError): os.remove(tmp_path)
+        raise
+
+def read_json(path: str, default: Any, expected_type: type = dict) -> Any:
+    # Содержимое файла или default, если файла нет, он повреждён или содержит не expected_type
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return default
+    return data if isinstance(data, expected_type) else default
+
+# --- Метрики запуска ---
+class RunMetrics:
+    # Интервалы (span) этапов и счётчики одного запуска; пишутся из event loop и из потока кодировщика
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started_at = datetime.datetime.now(datetime.timezone.utc)
+            self.origin = time.perf_counter()
+            self.spans: List[Dict[str, Any]] = []
+            self.counters: Dict[str, float] = {}
+            self.extra: Dict[str, Any] = {}
+
+    @contextlib.contextmanager
+    def span(self, stage: str, **attrs):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_span(stage, started, time.perf_counter(), **attrs)
+
+    def record_span(self, stage: str, started: float, finished: float, **attrs):
+        # Для интервалов, которые начинаются и заканчиваются в разных местах (колбэки future)
+        with self.lock:
+            self.spans.append({'stage': stage, **attrs, 'start_sec': round(started - self.origin, 6),
+                               'duration_sec': round(finished - started, 6)})
+
+    def count(self, name: str, value: float = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self) -> Dict[str, Any]:
+        with self.lock:
+            stages: Dict[str, Dict[str, float]] = {}
+            for span in self.spans:
+                stage = stages.setdefault(span['stage'], {'count': 0, 'total_sec': 0.0, 'max_sec': 0.0})
+                stage['count'] += 1
+                stage['total_sec'] = round(stage['total_sec'] + span['duration_sec'], 6)
+                stage['max_sec'] = max(stage['max_sec'], span['duration_sec'])
+            return {
+                'started_at': self.started_at.isoformat(),
+                'duration_sec': round(time.perf_counter() - self.origin, 6),
+                'stages': stages,
+                'counters': dict(self.counters),
+                'spans': list(self.spans),
+                **self.extra,
+            }
+
+    def write_report(self, path: Optional[str] = None):
+        path = path or RUN_REPORT_FILE
+        try:
+            write_json_atomic(path, self.report(), ensure_ascii=False, indent=1)
+            logger.info(f"Отчёт о запуске записан в {path}.")
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"Не удалось записать отчёт о запуске: {e}")
+
+metrics = RunMetrics()
 
 # --- Константы и конфигурация ---
-OPENWEATHER_API_URL = "https://api.openweathermap.org/data/3.0/onecall"
-AIR_POLLUTION_API_URL = "http://api.openweathermap.org/data/2.5/air_pollution"
+OPENWEATHER_API_URL = os.getenv("OPENWEATHER_API_URL", "https://api.openweathermap.org/data/3.0/onecall")
+AIR_POLLUTION_API_URL = os.getenv("AIR_POLLUTION_API_URL", "http://api.openweathermap.org/data/2.5/air_pollution")
+# Общий пул HTTP-соединений: лимит одновременных запросов, таймаут на установку соединения и на весь ответ (сек)
+HTTP_MAX_CONCURRENCY = int(os.getenv("HTTP_MAX_CONCURRENCY", "8"))
+HTTP_TIMEOUT_SEC = float(os.getenv("HTTP_TIMEOUT_SEC", "15"))
+HTTP_CONNECT_TIMEOUT_SEC = float(os.getenv("HTTP_CONNECT_TIMEOUT_SEC", "5"))
+# Повторы при сетевых ошибках, 429 и 5xx: экспоненциальная задержка со случайным разбросом (full jitter)
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+HTTP_BACKOFF_BASE_SEC = float(os.getenv("HTTP_BACKOFF_BASE_SEC", "0.5"))
+HTTP_BACKOFF_MAX_SEC = 8
+# Дублирующий (hedged) запрос, если ответа нет дольше указанного времени; 0 — отключено
+HTTP_HEDGE_AFTER_SEC = float(os.getenv("HTTP_HEDGE_AFTER_SEC", "0"))
+# Автомат отключения эндпоинта: после N ошибок подряд запросы не отправляются CIRCUIT_RESET_SEC секунд
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_SEC = float(os.getenv("CIRCUIT_RESET_SEC", "60"))
+# Последний удачный ответ API по каждому городу; используется (с пометкой на карточке), если API недоступен
+API_CACHE_DIR = os.getenv("API_CACHE_DIR", os.path.join(".cache", "api"))
+API_LAST_GOOD_MAX_AGE_HOURS = float(os.getenv("API_LAST_GOOD_MAX_AGE_HOURS", "24"))
+# Рендер карточек: пул процессов (process) или потоков (thread) и число воркеров (по умолчанию — число ядер)
+RENDER_EXECUTOR = os.getenv("RENDER_EXECUTOR", "process")
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", "0")) or os.cpu_count() or 1
+# Сколько готовых карточек может ждать кодировщика сверх тех, что рисуются прямо сейчас
+RENDER_QUEUE_SIZE = int(os.getenv("RENDER_QUEUE_SIZE", "2"))
 
 CITIES = {
     "Пномпень": {"lat": 11.5564, "lon": 104.9282},
@@ -27,12 +170,87 @@ CITIES = {
 }
 WATERMARK_FILE = "watermark.png"
 WATERMARK_SCALE_FACTOR = 0.5
+VIDEO_FPS = 20
+VIDEO_HOLD_DURATION_SEC = 5
+TRANSITION_STEPS = 15
+# Тип перехода между карточками городов: crossfade, slide или wipe
+TRANSITION_TYPE = os.getenv("TRANSITION_TYPE", "crossfade")
+TRANSITION_TYPES = ("crossfade", "slide", "wipe")
+# Сколько кадров перехода считается за один векторизованный проход
+TRANSITION_BATCH_SIZE = 5
+# Статичная карточка кодируется одним кадром с длительностью показа (VFR) вместо fps * hold_duration_sec копий
+VIDEO_DEDUPE_HOLD_FRAMES = os.getenv("VIDEO_DEDUPE_HOLD_FRAMES", "1") == "1"
+VIDEO_MACRO_BLOCK_SIZE = 16
+# Сколько готовых кадров может ждать кодировщика (пул заранее выделенных буферов)
+VIDEO_QUEUE_SIZE = int(os.getenv("VIDEO_QUEUE_SIZE", "8"))
+# Профиль кодирования libx264: fast, balanced (прежние настройки), small или auto — подбор пресета и CRF
+# под бюджет размера файла и времени кодирования по таблице калибровки прошлых запусков
+VIDEO_ENCODING_PROFILE = os.getenv("VIDEO_ENCODING_PROFILE", "balanced")
+ENCODING_PROFILES = {
+    "fast": {"preset": "veryfast", "crf": 28},
+    "balanced": {"preset": "slow", "crf": 28},
+    "small": {"preset": "veryslow", "crf": 32},
+}
+VIDEO_TARGET_BYTES = int(os.getenv("VIDEO_TARGET_BYTES", str(1024 * 1024)))
+VIDEO_ENCODE_BUDGET_SEC = float(os.getenv("VIDEO_ENCODE_BUDGET_SEC", "30"))
+ENCODING_CALIBRATION_FILE = os.getenv("ENCODING_CALIBRATION_FILE", os.path.join(".cache", "encoding_calibration.json"))
+# Кандидаты режима auto и относительные время/размер пресетов x264 (medium = 1) — для оценки ещё не опробованных
+# сочетаний по ближайшему измеренному; +6 CRF примерно вдвое уменьшают битрейт
+AUTO_PRESETS = ("veryfast", "faster", "fast", "medium", "slow", "slower", "veryslow")
+AUTO_CRF_RANGE = range(23, 37)
+PRESET_TIME_FACTORS = {"veryfast": 0.35, "faster": 0.55, "fast": 0.75, "medium": 1.0, "slow": 1.6, "slower": 3.0, "veryslow": 6.0}
+PRESET_SIZE_FACTORS = {"veryfast": 1.15, "faster": 1.08, "fast": 1.03, "medium": 1.0, "slow": 0.97, "slower": 0.95, "veryslow": 0.93}
+# Замер, упёршийся в потолок битрейта, занижает размер; его оценка увеличивается как при CRF на 2 меньше
+CAPPED_SIZE_FACTOR = 2 ** (2 / 6)
 AD_BUTTON_TEXT = "Новости 🇰🇭"
 AD_BUTTON_URL = "https://t.me/cambodiacriminal"
 NEWS_BUTTON_TEXT = "Обмен 💵"
 NEWS_BUTTON_URL = "https://t.me/mister1dollar"
 BACKGROUNDS_FOLDER = "backgrounds2"
+BACKGROUND_TARGET_WIDTH = 800
+# Кэш фонов, уже уменьшенных до нужной ширины: <sha256 файла>_<ширина>.npy + index.json (путь -> размер, mtime, хэш)
+BACKGROUND_CACHE_DIR = os.getenv("BACKGROUND_CACHE_DIR", os.path.join(".cache", "backgrounds"))
+# Кэш готовых карточек (<ключ>.npy) и видео (<ключ>.mp4); ключ — хэш всех входных данных рендера.
+# Версии увеличиваются при изменении вёрстки карточки или параметров кодирования, чтобы не взять устаревший кэш.
+RENDER_CACHE_DIR = os.getenv("RENDER_CACHE_DIR", os.path.join(".cache", "cards"))
+VIDEO_CACHE_DIR = os.getenv("VIDEO_CACHE_DIR", os.path.join(".cache", "videos"))
+RENDER_CACHE_VERSION = 2
+VIDEO_CACHE_VERSION = 1
+RENDER_CACHE_MAX_AGE_HOURS = float(os.getenv("RENDER_CACHE_MAX_AGE_HOURS", "72"))
+RENDER_CACHE_MAX_BYTES = int(os.getenv("RENDER_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
 MESSAGE_IDS_FILE = "message_ids.yml"
+# Отчёт о запуске (тайминги этапов и счётчики) и необязательное профилирование: WEATHER_PROFILE=cprofile,tracemalloc
+RUN_REPORT_FILE = os.getenv("RUN_REPORT_FILE", "run_report.json")
+WEATHER_PROFILE = os.getenv("WEATHER_PROFILE", "")
+PROFILE_OUTPUT_FILE = os.getenv("PROFILE_OUTPUT_FILE", "run_profile.prof")
+# Хранилище ID отправленных сообщений: sqlite (по умолчанию) или yaml (прежний формат MESSAGE_IDS_FILE).
+# При первом открытии sqlite-хранилища записи из MESSAGE_IDS_FILE переносятся в него автоматически.
+MESSAGE_STORE_BACKEND = os.getenv("MESSAGE_STORE_BACKEND", "sqlite")
+MESSAGE_STORE_FILE = os.getenv("MESSAGE_STORE_FILE", "message_ids.sqlite3")
+# Telegram удаляет до 100 сообщений за вызов и только в течение 48 часов после отправки
+TELEGRAM_DELETE_BATCH_SIZE = 100
+TELEGRAM_DELETE_WINDOW_HOURS = 48
+TELEGRAM_FLOOD_RETRIES = 5
+# Рассылка одного видео в несколько чатов (TARGET_CHAT_ID через запятую): загрузка один раз,
+# дальше — по file_id из кэша, не чаще TELEGRAM_SEND_RATE_PER_SEC отправок в секунду
+TELEGRAM_SEND_RATE_PER_SEC = float(os.getenv("TELEGRAM_SEND_RATE_PER_SEC", "20"))
+TELEGRAM_FILE_ID_CACHE_FILE = os.getenv("TELEGRAM_FILE_ID_CACHE_FILE", os.path.join(".cache", "telegram_file_ids.json"))
+TELEGRAM_FILE_ID_CACHE_SIZE = 50
+# Режим --serve: расписание как у workflow (UTC), файл состояния демона, окно догоняющего запуска после простоя (мин)
+SERVE_SCHEDULE = os.getenv("SERVE_SCHEDULE", "50 22,1,4,7,10,13,16 * * *")
+SERVE_STATE_FILE = os.getenv("SERVE_STATE_FILE", os.path.join(".cache", "serve_state.json"))
+SERVE_CATCH_UP_MINUTES = float(os.getenv("SERVE_CATCH_UP_MINUTES", "30"))
+SERVE_MAX_SLEEP_SEC = 60
+# Пауза после отправки анимации (сек); бенчмарк конвейера выставляет 0
+POST_PUBLISH_DELAY_SEC = float(os.getenv("POST_PUBLISH_DELAY_SEC", "10"))
+
+# Анализ почасового прогноза: горизонт (часы/дни), порог вероятности дождя, длина графика на карточке (часы)
+FORECAST_HOURS = 48
+FORECAST_DAYS = 8
+RAIN_POP_THRESHOLD = 0.35
+SPARKLINE_HOURS = 24
+SPARKLINE_HEIGHT_FACTOR = 0.12
+MIN_FONT_SIZE = 16
 
 DAY_ABBREVIATIONS = {0: 'пн', 1: 'вт', 2: 'ср', 3: 'чт', 4: 'пт', 5: 'сб', 6: 'вс'}
 DAYS_OF_WEEK_ACCUSATIVE = {0: 'понедельник', 1: 'вторник', 2: 'среду', 3: 'четверг', 4: 'пятницу', 5: 'субботу', 6: 'воскресенье'}
@@ -48,323 +266,1392 @@ AQI_INFO = {
 
 # --- Функции ---
 
-async def delete_old_messages(bot: Bot, chat_id: str):
-    if not os.path.exists(MESSAGE_IDS_FILE) or os.path.getsize(MESSAGE_IDS_FILE) == 0:
-        logger.info(f"Файл {MESSAGE_IDS_FILE} не найден или пуст, пропускаем удаление старых сообщений.")
-        return
+# --- Хранилище ID сообщений ---
+# Запись хранилища: (chat_id, message_id, sent_at). Пустой chat_id — запись старого формата без чата,
+# она относится к текущему TARGET_CHAT_ID.
+StoredMessage = Tuple[str, int, Optional[datetime.datetime]]
 
-    messages_to_process = []
+def _to_timestamp(moment: Optional[datetime.datetime]) -> Optional[float]:
+    return moment.timestamp() if moment is not None else None
+
+def _from_timestamp(value: Optional[float]) -> Optional[datetime.datetime]:
+    return datetime.datetime.fromtimestamp(value, tz=datetime.timezone.utc) if value is not None else None
+
+def _parse_sent_at(value: Any) -> Optional[datetime.datetime]:
+    if not value: return None
     try:
-        with open(MESSAGE_IDS_FILE, 'r') as f:
+        moment = value if isinstance(value, datetime.datetime) else datetime.datetime.fromisoformat(str(value))
+    except ValueError:
+        logger.warning(f"Не удалось распарсить 'sent_at': {value}.")
+        return None
+    # Скрипт всегда писал время в UTC; время без пояса (правка вручную) тоже считаем UTC, иначе его нельзя сравнить с cutoff
+    return moment if moment.tzinfo else moment.replace(tzinfo=datetime.timezone.utc)
+
+class MessageStore(abc.ABC):
+    # Интерфейс хранилища; реализации: SqliteMessageStore и YamlMessageStore
+    @abc.abstractmethod
+    def add(self, chat_id: str, message_id: int, sent_at: Optional[datetime.datetime]) -> bool: ...
+
+    @abc.abstractmethod
+    def contains(self, chat_id: str, message_id: int) -> bool: ...
+
+    @abc.abstractmethod
+    def messages(self, chat_id: Optional[str] = None) -> List[StoredMessage]: ...
+
+    @abc.abstractmethod
+    def remove(self, chat_id: str, message_ids: Iterable[int]) -> int: ...
+
+    @abc.abstractmethod
+    def remove_older_than(self, cutoff: datetime.datetime) -> List[StoredMessage]: ...
+
+    def close(self):
+        pass
+
+    def __enter__(self) -> "MessageStore":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class SqliteMessageStore(MessageStore):
+    # Первичный ключ (chat_id, message_id) — поиск по ID и выборка по чату, индекс по sent_at — очистка по возрасту.
+    # Каждое изменение — отдельная транзакция с журналом отката, так что падение не портит файл.
+    def __init__(self, path: str = MESSAGE_STORE_FILE):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=DELETE")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS messages (chat_id TEXT NOT NULL, message_id INTEGER NOT NULL, "
+                              "sent_at REAL, PRIMARY KEY (chat_id, message_id)) WITHOUT ROWID")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS messages_sent_at ON messages (sent_at)")
+
+    def add(self, chat_id: str, message_id: int, sent_at: Optional[datetime.datetime]) -> bool:
+        with self.conn:
+            cursor = self.conn.execute("INSERT OR IGNORE INTO messages (chat_id, message_id, sent_at) VALUES (?, ?, ?)",
+                                       (str(chat_id), int(message_id), _to_timestamp(sent_at)))
+        return cursor.rowcount > 0
+
+    def add_many(self, records: Iterable[StoredMessage]) -> int:
+        with self.conn:
+            cursor = self.conn.executemany("INSERT OR IGNORE INTO messages (chat_id, message_id, sent_at) VALUES (?, ?, ?)",
+                                           [(str(c), int(m), _to_timestamp(t)) for c, m, t in records])
+        return cursor.rowcount
+
+    def contains(self, chat_id: str, message_id: int) -> bool:
+        return self.conn.execute("SELECT 1 FROM messages WHERE chat_id = ? AND message_id = ?",
+                                 (str(chat_id), int(message_id))).fetchone() is not None
+
+    def messages(self, chat_id: Optional[str] = None) -> List[StoredMessage]:
+        if chat_id is None:
+            rows = self.conn.execute("SELECT chat_id, message_id, sent_at FROM messages ORDER BY chat_id, message_id")
+        else:
+            rows = self.conn.execute("SELECT chat_id, message_id, sent_at FROM messages WHERE chat_id = ? ORDER BY message_id", (str(chat_id),))
+        return [(c, m, _from_timestamp(t)) for c, m, t in rows]
+
+    def remove(self, chat_id: str, message_ids: Iterable[int]) -> int:
+        with self.conn:
+            cursor = self.conn.executemany("DELETE FROM messages WHERE chat_id = ? AND message_id = ?",
+                                           [(str(chat_id), int(m)) for m in message_ids])
+        return cursor.rowcount
+
+    def remove_older_than(self, cutoff: datetime.datetime) -> List[StoredMessage]:
+        with self.conn:
+            rows = self.conn.execute("SELECT chat_id, message_id, sent_at FROM messages WHERE sent_at < ?", (cutoff.timestamp(),)).fetchall()
+            self.conn.execute("DELETE FROM messages WHERE sent_at < ?", (cutoff.timestamp(),))
+        return [(c, m, _from_timestamp(t)) for c, m, t in rows]
+
+    def close(self):
+        self.conn.close()
+
+class YamlMessageStore(MessageStore):
+    # Прежний формат: список {message_id, sent_at[, chat_id]} в YAML. Индекс в памяти, файл переписывается
+    # атомарно (временный файл + os.replace) после каждого изменения.
+    def __init__(self, path: str = MESSAGE_IDS_FILE):
+        self.path = path
+        self.records: Dict[Tuple[str, int], Optional[datetime.datetime]] = {}
+        records = read_legacy_message_ids(path)
+        # Повреждённый файл откладываем в сторону, иначе первая же запись затрёт его пустым списком
+        if records is None: records = quarantine_legacy_file(path)
+        for chat_id, message_id, sent_at in records:
+            self.records.setdefault((chat_id, message_id), sent_at)
+
+    def _flush(self):
+        data = []
+        for (chat_id, message_id), sent_at in self.records.items():
+            entry: Dict[str, Any] = {'message_id': message_id, 'sent_at': sent_at.isoformat() if sent_at else None}
+            if chat_id: entry['chat_id'] = chat_id
+            data.append(entry)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            yaml.dump(data, f, default_flow_style=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def add(self, chat_id: str, message_id: int, sent_at: Optional[datetime.datetime]) -> bool:
+        key = (str(chat_id), int(message_id))
+        if key in self.records: return False
+        self.records[key] = sent_at
+        self._flush()
+        return True
+
+    def contains(self, chat_id: str, message_id: int) -> bool:
+        return (str(chat_id), int(message_id)) in self.records
+
+    def messages(self, chat_id: Optional[str] = None) -> List[StoredMessage]:
+        return [(c, m, t) for (c, m), t in sorted(self.records.items()) if chat_id is None or c == str(chat_id)]
+
+    def remove(self, chat_id: str, message_ids: Iterable[int]) -> int:
+        removed = 0
+        for message_id in message_ids:
+            key = (str(chat_id), int(message_id))
+            if key in self.records:
+                del self.records[key]
+                removed += 1
+        if removed: self._flush()
+        return removed
+
+    def remove_older_than(self, cutoff: datetime.datetime) -> List[StoredMessage]:
+        expired = [(c, m, t) for (c, m), t in self.records.items() if t is not None and t < cutoff]
+        for c, m, _ in expired: del self.records[(c, m)]
+        if expired: self._flush()
+        return expired
+
+def read_legacy_message_ids(path: str = MESSAGE_IDS_FILE) -> Optional[List[StoredMessage]]:
+    # None — файл есть, но прочитать его не удалось (в отличие от пустого списка для пустого/отсутствующего файла)
+    if not os.path.exists(path) or os.path.getsize(path) == 0: return []
+    try:
+        with open(path, 'r') as f:
             loaded_data = yaml.safe_load(f)
-            if isinstance(loaded_data, list):
-                messages_to_process = loaded_data
+    except (OSError, yaml.YAMLError) as e:
+        logger.error(f"Файл {path} поврежден или недоступен, записи из него не прочитаны: {e}")
+        return None
+    if loaded_data is None: return []
+    if not isinstance(loaded_data, list):
+        logger.error(f"Файл {path} содержит некорректные данные (не список).")
+        return None
+    records = []
+    for msg_info in loaded_data:
+        # Битая запись пропускается, остальные переносятся — иначе файл не мигрировал бы никогда
+        try:
+            message_id = int(msg_info['message_id'])
+            if message_id <= 0: raise ValueError(message_id)
+        except (KeyError, TypeError, ValueError):
+            logger.warning(f"Найден элемент без корректного 'message_id' в {path}: {msg_info}. Пропускаем.")
+            continue
+        records.append((str(msg_info.get('chat_id') or ''), message_id, _parse_sent_at(msg_info.get('sent_at'))))
+    return records
+
+def quarantine_legacy_file(path: str) -> List[StoredMessage]:
+    # Нечитаемый файл переименовывается в *.bak, а не удаляется: ID из него можно восстановить вручную
+    backup_path = f"{path}.bak"
+    if os.path.exists(backup_path): backup_path = f"{path}.{int(time.time())}.bak"
+    try:
+        os.replace(path, backup_path)
+        logger.warning(f"Файл {path} не прочитан и сохранён как {backup_path}; старые сообщения из него не будут удалены автоматически.")
+    except OSError as e:
+        logger.warning(f"Файл {path} не прочитан и не переименован ({e}), оставляем его на месте.")
+    return []
+
+def open_message_store() -> MessageStore:
+    if MESSAGE_STORE_BACKEND == "yaml":
+        return YamlMessageStore(MESSAGE_IDS_FILE)
+    store = SqliteMessageStore(MESSAGE_STORE_FILE)
+    # Автоматическая миграция: переносим записи из YAML и удаляем его только после успешного разбора и записи в базу
+    if os.path.exists(MESSAGE_IDS_FILE):
+        legacy_records = read_legacy_message_ids(MESSAGE_IDS_FILE)
+        if legacy_records is None:
+            quarantine_legacy_file(MESSAGE_IDS_FILE)
+        else:
+            store.add_many(legacy_records)
+            os.remove(MESSAGE_IDS_FILE)
+            logger.info(f"Записи из {MESSAGE_IDS_FILE} ({len(legacy_records)}) перенесены в {MESSAGE_STORE_FILE}.")
+    return store
+
+async def call_with_flood_control(method, *args, retries: int = TELEGRAM_FLOOD_RETRIES, **kwargs):
+    # Пауза только тогда, когда Telegram сам просит подождать (RetryAfter), и ровно на указанное время
+    for attempt in range(retries + 1):
+        try:
+            return await method(*args, **kwargs)
+        except telegram_error.RetryAfter as e:
+            if attempt == retries: raise
+            delay = e.retry_after.total_seconds() if isinstance(e.retry_after, datetime.timedelta) else float(e.retry_after)
+            logger.warning(f"Flood control Telegram: повтор через {delay:.1f} с (попытка {attempt + 1}/{retries}).")
+            await asyncio.sleep(delay)
+
+async def delete_chat_messages(bot: telegram.Bot, chat_id: str, message_ids: List[int]) -> List[int]:
+    # Удаляет сообщения одного чата пачками; возвращает ID, которые стоит попробовать удалить в следующий раз
+    failed = []
+    for start in range(0, len(message_ids), TELEGRAM_DELETE_BATCH_SIZE):
+        batch = message_ids[start:start + TELEGRAM_DELETE_BATCH_SIZE]
+        try:
+            await call_with_flood_control(bot.delete_messages, chat_id=chat_id, message_ids=batch)
+            logger.info(f"В чате {chat_id} удалено сообщений: {len(batch)}.")
+        except telegram_error.BadRequest as e:
+            if "message to delete not found" in str(e).lower() or "message can't be deleted" in str(e).lower():
+                logger.warning(f"Сообщения {batch} в чате {chat_id} не удалось удалить (уже удалены или не существуют).")
             else:
-                logger.warning(f"Файл {MESSAGE_IDS_FILE} содержит некорректные данные (не список), очищаем его.")
-                with open(MESSAGE_IDS_FILE, 'w') as out_f: yaml.dump([], out_f)
+                logger.error(f"Непредвиденная ошибка при удалении сообщений {batch} в чате {chat_id}: {e}")
+                failed.extend(batch)
+        except Exception as e:
+            logger.error(f"Неизвестная ошибка при удалении сообщений {batch} в чате {chat_id}: {e}")
+            failed.extend(batch)
+    return failed
+
+async def delete_old_messages(bot: telegram.Bot, chat_id: str):
+    try:
+        with open_message_store() as store:
+            # Сообщения старше 48 часов Telegram удалить не даст — убираем их из хранилища без запросов к API
+            cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=TELEGRAM_DELETE_WINDOW_HOURS)
+            expired = store.remove_older_than(cutoff)
+            if expired:
+                logger.warning(f"Сообщения {[m for _, m, _ in expired]} отправлены более {TELEGRAM_DELETE_WINDOW_HOURS} ч назад, Telegram не даст их удалить. Пропускаем.")
+
+            # Группируем по чатам (записи без chat_id относятся к текущему чату)
+            by_chat: Dict[str, Dict[str, List[int]]] = {}
+            for stored_chat_id, message_id, _ in store.messages():
+                by_chat.setdefault(stored_chat_id or str(chat_id), {}).setdefault(stored_chat_id, []).append(message_id)
+            if not by_chat:
+                logger.info("Хранилище не содержит сообщений для удаления.")
                 return
 
-        if not messages_to_process:
-            logger.info(f"Файл {MESSAGE_IDS_FILE} не содержит сообщений для удаления.")
+            # Разные чаты обрабатываются параллельно, внутри чата — пачками
+            chats = list(by_chat)
+            failed_per_chat = await asyncio.gather(*(delete_chat_messages(bot, chat, [m for ids in by_chat[chat].values() for m in ids]) for chat in chats))
+            remaining = []
+            for chat, failed in zip(chats, failed_per_chat):
+                failed = set(failed)
+                for stored_chat_id, message_ids in by_chat[chat].items():
+                    store.remove(stored_chat_id, [m for m in message_ids if m not in failed])
+                remaining += sorted(failed)
+
+            if remaining:
+                logger.warning(f"Некоторые сообщения не были удалены и остаются в хранилище для повторной попытки: {remaining}")
+            else:
+                logger.info("Все старые сообщения были обработаны.")
+    except Exception as e:
+        logger.error(f"Критическая ошибка при удалении старых сообщений: {e}")
+
+# --- Публикация ---
+def parse_chat_ids(value: Optional[str]) -> List[str]:
+    return [chat.strip() for chat in (value or "").replace(";", ",").split(",") if chat.strip()]
+
+class RateLimiter:
+    # Равномерно разносит вызовы wait() во времени: не чаще rate_per_sec в секунду
+    def __init__(self, rate_per_sec: float):
+        self.interval = 1.0 / rate_per_sec if rate_per_sec > 0 else 0.0
+        self.next_slot = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            delay = self.next_slot - now
+            if delay > 0: await asyncio.sleep(delay)
+            self.next_slot = max(now, self.next_slot) + self.interval
+
+def load_file_id_cache() -> Dict[str, Dict[str, Any]]:
+    # Записи без строкового file_id (повреждённый или чужой файл) отбрасываются
+    cache = read_json(TELEGRAM_FILE_ID_CACHE_FILE, {})
+    return {key: entry for key, entry in cache.items() if isinstance(entry, dict) and isinstance(entry.get('file_id'), str)}
+
+def save_file_id_cache(cache: Dict[str, Dict[str, Any]]):
+    # Храним только последние TELEGRAM_FILE_ID_CACHE_SIZE записей
+    recent = dict(sorted(cache.items(), key=lambda item: item[1].get('saved_at', 0))[-TELEGRAM_FILE_ID_CACHE_SIZE:])
+    try:
+        write_json_atomic(TELEGRAM_FILE_ID_CACHE_FILE, recent, indent=1)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить кэш file_id: {e}")
+
+async def publish_video(bot: telegram.Bot, chat_ids: List[str], video_path: str, **send_kwargs) -> Dict[str, int]:
+    # Файл загружается в Telegram один раз; остальные чаты получают его по file_id параллельно.
+    # file_id кэшируется по хэшу содержимого видео (и боту), так что повторное видео вообще не загружается.
+    # Возвращает {chat_id: message_id} для успешно отправленных сообщений.
+    cache_key = f"{bot.token.split(':')[0]}:{file_content_hash(video_path)}"
+    file_id_cache = load_file_id_cache()
+    file_id = file_id_cache.get(cache_key, {}).get('file_id')
+    if file_id is not None: metrics.count('file_id_cache_hits')
+    limiter = RateLimiter(TELEGRAM_SEND_RATE_PER_SEC)
+    sent: Dict[str, int] = {}
+
+    async def upload(chat_id: str) -> Optional[str]:
+        async def send():
+            with open(video_path, 'rb') as video_file:
+                return await bot.send_animation(chat_id=chat_id, animation=video_file, **send_kwargs)
+        await limiter.wait()
+        with metrics.span('upload', chat=chat_id, mode='file'):
+            message = await call_with_flood_control(send)
+        metrics.count('bytes_uploaded', os.path.getsize(video_path))
+        sent[chat_id] = message.message_id
+        logger.info(f"Анимация MP4 загружена и отправлена в чат {chat_id}. ID: {message.message_id}.")
+        media = message.animation or message.document or message.video
+        return media.file_id if media else None
+
+    def remember(new_file_id: Optional[str]):
+        nonlocal file_id
+        if not new_file_id: return
+        file_id = new_file_id
+        file_id_cache[cache_key] = {'file_id': file_id, 'saved_at': time.time()}
+        save_file_id_cache(file_id_cache)
+
+    async def send_cached(chat_id: str):
+        used_file_id = file_id
+        await limiter.wait()
+        try:
+            with metrics.span('upload', chat=chat_id, mode='file_id'):
+                message = await call_with_flood_control(bot.send_animation, chat_id=chat_id, animation=used_file_id, **send_kwargs)
+        except telegram_error.BadRequest as e:
+            # Прочие ошибки (чат, подпись, права) повторной загрузкой не исправить
+            if not is_file_id_error(e): raise
+            async with reupload_lock:
+                # Устаревший file_id заменяет только первый столкнувшийся с ним чат, остальные берут новый
+                if file_id == used_file_id:
+                    logger.warning(f"file_id не принят в чате {chat_id} ({e}), загружаем файл заново.")
+                    remember(await upload(chat_id))
+                    return
+            await send_cached(chat_id)
             return
+        sent[chat_id] = message.message_id
+        logger.info(f"Анимация MP4 отправлена в чат {chat_id} по file_id. ID: {message.message_id}.")
 
-        remaining_messages_to_delete = []
-        now_utc = datetime.datetime.now(datetime.timezone.utc)
-        
-        for msg_info in messages_to_process:
-            message_id = msg_info.get('message_id')
-            sent_at_str = msg_info.get('sent_at')
+    reupload_lock = asyncio.Lock()
+    pending = list(chat_ids)
+    while file_id is None and pending:
+        chat_id = pending.pop(0)
+        try:
+            remember(await upload(chat_id))
+        except Exception as e:
+            logger.error(f"Ошибка при отправке MP4 в чат {chat_id}: {e}")
 
-            if not message_id:
-                logger.warning(f"Найден элемент без 'message_id' в {MESSAGE_IDS_FILE}: {msg_info}. Пропускаем.")
-                continue
+    if file_id is not None and pending:
+        results = await asyncio.gather(*(send_cached(chat_id) for chat_id in pending), return_exceptions=True)
+        for chat_id, result in zip(pending, results):
+            if isinstance(result, Exception):
+                logger.error(f"Ошибка при отправке MP4 в чат {chat_id}: {result}")
+    return sent
 
-            # Проверка возраста сообщения (если sent_at доступно)
-            if sent_at_str:
-                try:
-                    sent_at = datetime.datetime.fromisoformat(sent_at_str)
-                    age_hours = (now_utc - sent_at).total_seconds() / 3600
-                    if age_hours > 47.5: # Чуть меньше 48 часов, чтобы быть уверенным
-                        logger.warning(f"Сообщение {message_id} отправлено более 47.5 часов назад ({age_hours:.1f}ч). Telegram может запретить удаление.")
-                        pass 
-                except ValueError:
-                    logger.warning(f"Не удалось распарсить 'sent_at' для сообщения {message_id}: {sent_at_str}. Пробуем удалить.")
+def is_file_id_error(error: Exception) -> bool:
+    # Telegram не принял file_id: устарел, выдан другому боту или указывает не на тот тип файла
+    text = str(error).lower()
+    return any(marker in text for marker in ("file identifier", "file_id", "wrong file", "file reference", "media_empty"))
 
-            try:
-                await bot.delete_message(chat_id=chat_id, message_id=message_id)
-                logger.info(f"Сообщение {message_id} удалено.")
-            except BadRequest as e:
-                if "message to delete not found" in str(e).lower() or "message can't be deleted" in str(e).lower():
-                    logger.warning(f"Сообщение {message_id} не удалось удалить (уже удалено или не существует).")
-                else:
-                    logger.error(f"Непредвиденная ошибка при удалении сообщения {message_id}: {e}")
-                    remaining_messages_to_delete.append(msg_info)
-            except Exception as e:
-                logger.error(f"Неизвестная ошибка при удалении сообщения {message_id}: {e}")
-                remaining_messages_to_delete.append(msg_info)
-            await asyncio.sleep(0.5)
-
-        if remaining_messages_to_delete:
-            logger.warning(f"Некоторые сообщения не были удалены и остаются в {MESSAGE_IDS_FILE} для повторной попытки: {[m.get('message_id') for m in remaining_messages_to_delete]}")
-            with open(MESSAGE_IDS_FILE, 'w') as out_f:
-                yaml.dump(remaining_messages_to_delete, out_f, default_flow_style=False)
+def create_http_client(max_connections: int = HTTP_MAX_CONCURRENCY, timeout: float = HTTP_TIMEOUT_SEC) -> httpx.AsyncClient:
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    return httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(timeout, connect=HTTP_CONNECT_TIMEOUT_SEC))
+
+class CircuitOpenError(Exception):
+    pass
+
+class CircuitBreaker:
+    # closed -> open после failure_threshold ошибок подряд; через reset_timeout_sec пропускается одна пробная
+    # попытка (half-open): успех закрывает автомат, ошибка снова открывает его на reset_timeout_sec
+    def __init__(self, name: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD, reset_timeout_sec: float = CIRCUIT_RESET_SEC):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_sec = reset_timeout_sec
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_flight = False
+
+    def allow(self) -> bool:
+        if self.opened_at is None: return True
+        if not self.trial_in_flight and time.monotonic() - self.opened_at >= self.reset_timeout_sec:
+            self.trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.opened_at is not None: logger.info(f"Эндпоинт {self.name} снова отвечает, автомат закрыт.")
+        self.failures, self.opened_at, self.trial_in_flight = 0, None, False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.trial_in_flight or (self.opened_at is None and self.failures >= self.failure_threshold):
+            logger.warning(f"Эндпоинт {self.name}: {self.failures} ошибок подряд, запросы приостановлены на {self.reset_timeout_sec:g} с.")
+            self.opened_at = time.monotonic()
+        self.trial_in_flight = False
+
+circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+def get_circuit_breaker(endpoint: str) -> CircuitBreaker:
+    if endpoint not in circuit_breakers: circuit_breakers[endpoint] = CircuitBreaker(endpoint)
+    return circuit_breakers[endpoint]
+
+def describe_http_error(error: Exception) -> str:
+    # Текст исключений httpx содержит URL с appid — в лог идут только тип ошибки и код ответа
+    if isinstance(error, httpx.HTTPStatusError): return f"HTTP {error.response.status_code}"
+    return str(error) if isinstance(error, CircuitOpenError) else type(error).__name__
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, httpx.HTTPStatusError): return error.response.status_code == 429 or error.response.status_code >= 500
+    return isinstance(error, (httpx.TransportError, ValueError))
+
+async def _request_json(client: httpx.AsyncClient, url: str, params: Dict[str, Any]) -> Dict:
+    # Таймауты httpx действуют на каждую операцию чтения; общий срок ответа ограничиваем отдельно
+    try:
+        response = await asyncio.wait_for(client.get(url, params=params), HTTP_TIMEOUT_SEC)
+    except asyncio.TimeoutError:
+        raise httpx.ReadTimeout(f"нет ответа за {HTTP_TIMEOUT_SEC:g} с") from None
+    response.raise_for_status()
+    return response.json()
+
+async def _hedged_request_json(client: httpx.AsyncClient, url: str, params: Dict[str, Any]) -> Dict:
+    # Если первый запрос не ответил за HTTP_HEDGE_AFTER_SEC, параллельно отправляется второй; берётся первый успешный ответ
+    if HTTP_HEDGE_AFTER_SEC <= 0: return await _request_json(client, url, params)
+    pending = {asyncio.create_task(_request_json(client, url, params))}
+    done, _ = await asyncio.wait(pending, timeout=HTTP_HEDGE_AFTER_SEC)
+    if not done:
+        metrics.count('http_hedged_requests')
+        pending.add(asyncio.create_task(_request_json(client, url, params)))
+    error: Optional[BaseException] = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None: return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in pending: task.cancel()
+
+async def _get_json(url: str, params: Dict[str, Any], client: Optional[httpx.AsyncClient], endpoint: str = "",
+                    semaphore: Optional[asyncio.Semaphore] = None) -> Dict:
+    if client is None:
+        async with create_http_client() as own_client:
+            return await _get_json(url, params, own_client, endpoint, semaphore)
+    breaker = get_circuit_breaker(endpoint or url)
+    for attempt in range(HTTP_RETRIES + 1):
+        unsettled = False
+        try:
+            # Слот семафора занимается только на время попытки: пауза перед повтором не держит его,
+            # и во время сбоя повторяющиеся города не задерживают запросы остальных
+            async with semaphore or contextlib.nullcontext():
+                # Автомат проверяется уже со слотом: за время ожидания в очереди он мог открыться
+                if not breaker.allow():
+                    metrics.count('circuit_open_skips')
+                    raise CircuitOpenError(f"эндпоинт {breaker.name} временно отключён")
+                unsettled = True
+                data = await _hedged_request_json(client, url, params)
+        except (httpx.HTTPError, ValueError) as e:
+            unsettled = False
+            # Ответ 4xx (кроме 429) — сервис работает, ошибка в запросе: автомат не трогаем и не повторяем
+            if not is_retryable(e):
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            if attempt == HTTP_RETRIES: raise
+            delay = random.uniform(0, min(HTTP_BACKOFF_MAX_SEC, HTTP_BACKOFF_BASE_SEC * 2 ** attempt))
+            metrics.count('http_retries')
+            logger.warning(f"Запрос к {breaker.name} не удался ({describe_http_error(e)}), попытка {attempt + 2} через {delay:.1f} с.")
+            await asyncio.sleep(delay)
         else:
-            logger.info(f"Все старые сообщения из {MESSAGE_IDS_FILE} были обработаны. Файл будет очищен.")
-            with open(MESSAGE_IDS_FILE, 'w') as out_f:
-                yaml.dump([], out_f)
-        
-    except Exception as e:
-        logger.error(f"Критическая ошибка при обработке message_ids.yml: {e}")
-        with open(MESSAGE_IDS_FILE, 'w') as out_f:
-            yaml.dump([], out_f)
-        logger.warning(f"Файл {MESSAGE_IDS_FILE} был принудительно очищен из-за ошибки.")
+            unsettled = False
+            breaker.record_success()
+            return data
+        finally:
+            # Прочие исключения (отмена, httpx.InvalidURL, RuntimeError потоков httpx) — тоже неудачная попытка:
+            # иначе пробный запрос half-open остался бы занятым и автомат не пропускал бы запросы до перезапуска
+            if unsettled: breaker.record_failure()
 
-async def get_current_weather(coords: Dict[str, float], api_key: str) -> Optional[Dict]:
-    params = {"lat": coords["lat"], "lon": coords["lon"], "appid": api_key, "units": "metric", "lang": "ru", "exclude": "minutely,alerts"}
+def _last_good_path(endpoint: str, coords: Dict[str, float]) -> str:
+    return os.path.join(API_CACHE_DIR, f"{endpoint}_{coords['lat']}_{coords['lon']}.json")
+
+def save_last_good_response(endpoint: str, coords: Dict[str, float], data: Dict):
+    path = _last_good_path(endpoint, coords)
     try:
-        response = requests.get(OPENWEATHER_API_URL, params=params)
-        response.raise_for_status()
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка при запросе погоды: {e}")
-        return None
+        write_json_atomic(path, {'fetched_at': time.time(), 'data': data}, ensure_ascii=False)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить ответ API в {path}: {e}")
+
+def load_last_good_response(endpoint: str, coords: Dict[str, float]) -> Optional[Tuple[Dict, float]]:
+    # Возвращает (данные, время получения) последнего удачного ответа, если он не старше API_LAST_GOOD_MAX_AGE_HOURS
+    entry = read_json(_last_good_path(endpoint, coords), {})
+    if not isinstance(entry.get('data'), dict) or not isinstance(entry.get('fetched_at'), (int, float)): return None
+    if time.time() - entry['fetched_at'] > API_LAST_GOOD_MAX_AGE_HOURS * 3600: return None
+    metrics.count('stale_fallbacks')
+    return entry['data'], entry['fetched_at']
+
+async def fetch_json_with_fallback(url: str, params: Dict[str, Any], coords: Dict[str, float], client: Optional[httpx.AsyncClient],
+                                   endpoint: str, what: str, semaphore: Optional[asyncio.Semaphore] = None) -> Tuple[Optional[Dict], Optional[float]]:
+    # (данные, время получения устаревших данных или None для свежих)
+    try:
+        data = await _get_json(url, params, client, endpoint, semaphore)
+    except (httpx.HTTPError, ValueError, CircuitOpenError) as e:
+        logger.error(f"Ошибка при запросе {what}: {describe_http_error(e)}")
+        last_good = load_last_good_response(endpoint, coords)
+        if last_good is None: return None, None
+        logger.warning(f"Для {what} используется последний удачный ответ от "
+                       f"{datetime.datetime.fromtimestamp(last_good[1], tz=datetime.timezone.utc):%Y-%m-%d %H:%M} UTC.")
+        return last_good
+    save_last_good_response(endpoint, coords, data)
+    return data, None
+
+async def get_current_weather(coords: Dict[str, float], api_key: str, client: Optional[httpx.AsyncClient] = None,
+                              semaphore: Optional[asyncio.Semaphore] = None) -> Optional[Dict]:
+    params = {"lat": coords["lat"], "lon": coords["lon"], "appid": api_key, "units": "metric", "lang": "ru", "exclude": "minutely,alerts"}
+    data, stale_since = await fetch_json_with_fallback(OPENWEATHER_API_URL, params, coords, client, 'onecall', "погоды", semaphore)
+    # Устаревшие данные помечаются временем получения — карточка покажет, что прогноз не свежий
+    if data is not None and stale_since is not None: data = {**data, 'stale_since': stale_since}
+    return data
 
 # --- НОВАЯ ФУНКЦИЯ ДЛЯ POLLUTION (Возвращает кортеж: индекс AQI, PM2.5) ---
-async def get_air_quality(coords: Dict[str, float], api_key: str) -> Optional[Tuple[int, float]]:
+async def get_air_quality(coords: Dict[str, float], api_key: str, client: Optional[httpx.AsyncClient] = None,
+                          semaphore: Optional[asyncio.Semaphore] = None) -> Optional[Tuple[int, float]]:
     params = {"lat": coords["lat"], "lon": coords["lon"], "appid": api_key}
+    data, _ = await fetch_json_with_fallback(AIR_POLLUTION_API_URL, params, coords, client, 'air_pollution', "качества воздуха", semaphore)
     try:
-        response = requests.get(AIR_POLLUTION_API_URL, params=params)
-        response.raise_for_status()
-        data = response.json()
-        if 'list' in data and len(data['list']) > 0:
+        if data and 'list' in data and len(data['list']) > 0:
             aqi = data['list'][0]['main']['aqi']
             pm2_5 = data['list'][0]['components']['pm2_5']
             return aqi, pm2_5
-        return None
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка при запросе качества воздуха: {e}")
-        return None
+    except (KeyError, TypeError) as e:
+        logger.error(f"Ошибка при разборе качества воздуха: {e}")
+    return None
 
-def format_precipitation_forecast(weather_data: Dict) -> List[str]:
-    try:
-        hourly = weather_data.get('hourly', [])
-        offset = weather_data.get('timezone_offset', 0)
-        current_ts = weather_data.get('current', {}).get('dt')
-        if not hourly or not current_ts: return ["Осадков не ожидается"]
-
-        rainy_hours_data = []
-        for hour in hourly[:48]:
-            if hour.get('dt', 0) > current_ts and hour.get('pop', 0) > 0.35:
-                rainy_hours_data.append(hour)
-
-        if not rainy_hours_data: return ["Осадков не ожидается"]
-
-        intervals, i = [], 0
-        while i < len(rainy_hours_data):
-            start_hour_data, end_hour_data = rainy_hours_data[i], rainy_hours_data[i]
-            while i + 1 < len(rainy_hours_data) and rainy_hours_data[i+1]['dt'] == end_hour_data['dt'] + 3600:
-                end_hour_data = rainy_hours_data[i+1]
-                i += 1
-            intervals.append((start_hour_data, end_hour_data))
-            i += 1
-        
-        output_lines = []
-        for start_hour, end_hour in intervals[:2]:
-            start_dt = datetime.datetime.fromtimestamp(start_hour['dt'], tz=datetime.timezone.utc)
-            end_dt = datetime.datetime.fromtimestamp(end_hour['dt'], tz=datetime.timezone.utc)
-            
-            max_rain_volume, intensity_description = 0, "Дождь"
-            interval_hours = [h for h in hourly if start_hour['dt'] <= h['dt'] <= end_hour['dt']]
-            for hour in interval_hours:
-                rain_volume = hour.get('rain', {}).get('1h', 0)
-                if rain_volume > max_rain_volume:
-                    max_rain_volume = rain_volume
-                    intensity_description = hour.get('weather', [{}])[0].get('description', 'Дождь').capitalize()
-
-            local_start = start_dt + datetime.timedelta(seconds=offset)
-            local_end_display = end_dt + datetime.timedelta(hours=1) + datetime.timedelta(seconds=offset)
-
-            start_day_abbr = DAY_ABBREVIATIONS[local_start.weekday()]
-            end_day_abbr = DAY_ABBREVIATIONS[local_end_display.weekday()]
-
-            if local_start.day == local_end_display.day or local_end_display.strftime('%H:%M') == '00:00':
-                 end_time_str = local_end_display.strftime('%H:%M')
-                 if end_time_str == '00:00':
-                     end_time_str = '24:00'
-                 output_lines.append(f"• {start_day_abbr}, {local_start.strftime('%H:%M')} - {end_time_str} ({intensity_description})")
+async def fetch_city(coords: Dict[str, float], api_key: str, client: httpx.AsyncClient,
+                     semaphore: asyncio.Semaphore, city_name: str = "") -> Tuple[Optional[Dict], Optional[Tuple[int, float]]]:
+    # Погода и качество воздуха одного города запрашиваются параллельно; семафор общий для всех городов
+    # и занимается на каждую попытку запроса отдельно (см. _get_json)
+    async def timed(coro, endpoint: str):
+        with metrics.span('fetch', city=city_name, endpoint=endpoint):
+            return await coro
+
+    weather_data, aqi_result = await asyncio.gather(timed(get_current_weather(coords, api_key, client, semaphore), 'onecall'),
+                                                    timed(get_air_quality(coords, api_key, client, semaphore), 'air_pollution'))
+    return weather_data, aqi_result
+
+# --- Колоночный анализ прогноза ---
+def forecast_columns(batch: List[Dict]) -> Dict[str, Any]:
+    # JSON One Call нескольких городов разбирается один раз в массивы (город × час) и (город × день);
+    # все дальнейшие расчёты — векторные по всему пакету. Незаполненные ячейки помечены valid=False.
+    # Почасовые и дневные данные разбираются независимо: ошибка в daily не лишает город прогноза осадков.
+    n = len(batch)
+    hourly_values = np.zeros((n, 4, FORECAST_HOURS))  # dt, pop, rain, temp — одним присваиванием на город
+    daily_values = np.zeros((n, 2, FORECAST_DAYS))  # min, max
+    valid = np.zeros((n, FORECAST_HOURS), dtype=bool)
+    daily_valid = np.zeros((n, FORECAST_DAYS), dtype=bool)
+    ok, current_dt, offsets, raw_hourly = [True] * n, [0] * n, [0] * n, [[] for _ in range(n)]
+    for i, weather_data in enumerate(batch):
+        try:
+            current_dt[i] = int(weather_data.get('current', {}).get('dt') or 0)
+            offsets[i] = int(weather_data.get('timezone_offset', 0))
+            hourly = weather_data.get('hourly', [])[:FORECAST_HOURS]
+            dt, pop, rain, temp = [], [], [], []
+            for hour in hourly:
+                dt.append(hour.get('dt', 0))
+                pop.append(hour.get('pop', 0))
+                rain.append(hour.get('rain', {}).get('1h', 0))
+                temp.append(hour.get('temp', 0))
+            if hourly:
+                hourly_values[i, :, :len(hourly)] = (dt, pop, rain, temp)
+                valid[i, :len(hourly)] = True
+            # Описание нужно только для часа пика — берётся из исходных данных в rain_intervals
+            raw_hourly[i] = hourly
+        except (AttributeError, KeyError, IndexError, TypeError, ValueError) as e:
+            logger.error(f"Ошибка при разборе почасового прогноза: {e}")
+            ok[i] = False
+            valid[i] = False
+        daily = weather_data.get('daily') if isinstance(weather_data, dict) else None
+        lows, highs, days_ok = [], [], []
+        for d, day in enumerate(daily[:FORECAST_DAYS] if isinstance(daily, list) else []):
+            # Битый день пропускается, остальные дни сводки остаются
+            try:
+                low, high = float(day['temp']['min']), float(day['temp']['max'])
+            except (AttributeError, KeyError, IndexError, TypeError, ValueError) as e:
+                logger.warning(f"Ошибка при разборе дневного прогноза (день {d}): {e}")
+                low, high, day_ok = 0.0, 0.0, False
             else:
-                output_lines.append(f"• {start_day_abbr}, {local_start.strftime('%H:%M')} - {end_day_abbr}, {local_end_display.strftime('%H:%M')} ({intensity_description})")
-        
-        return output_lines
+                day_ok = True
+            lows.append(low)
+            highs.append(high)
+            days_ok.append(day_ok)
+        if days_ok:
+            daily_values[i, :, :len(days_ok)] = (lows, highs)
+            daily_valid[i, :len(days_ok)] = days_ok
+    return {
+        'ok': ok,
+        'current_dt': np.array(current_dt, dtype=np.int64),
+        'offset': offsets,
+        'valid': valid,
+        'dt': hourly_values[:, 0].astype(np.int64),
+        'pop': hourly_values[:, 1],
+        'rain': hourly_values[:, 2],
+        'temp': hourly_values[:, 3],
+        'hourly': raw_hourly,
+        'daily_valid': daily_valid,
+        'temp_min': daily_values[:, 0],
+        'temp_max': daily_values[:, 1],
+    }
 
-    except Exception as e:
-        logger.error(f"Ошибка при форматировании прогноза: {e}")
-        return ["Прогноз недоступен"]
+def hour_description(hour: Dict) -> str:
+    weather = hour.get('weather')
+    first = weather[0] if isinstance(weather, list) and weather else {}
+    return first.get('description', 'Дождь') if isinstance(first, dict) else 'Дождь'
+
+def rain_intervals(columns: Dict[str, Any], limit: int = 2) -> List[List[Tuple[int, int, float, str]]]:
+    # Дождливые часы (после текущего момента, вероятность выше порога) всех городов идут одним плоским массивом;
+    # интервал начинается там, где сменился город или прервалась почасовая последовательность.
+    # Для каждого интервала: (dt начала, dt последнего часа, пик осадков мм/ч, описание в час пика).
+    intervals: List[List[Tuple[int, int, float, str]]] = [[] for _ in range(len(columns['ok']))]
+    current_dt = columns['current_dt'][:, None]
+    rainy = columns['valid'] & (columns['dt'] > current_dt) & (current_dt > 0) & (columns['pop'] > RAIN_POP_THRESHOLD)
+    rows, cols = np.nonzero(rainy)
+    if not len(rows): return intervals
+    hour_dt, rain = columns['dt'][rows, cols], columns['rain'][rows, cols]
+    starts = np.ones(len(rows), dtype=bool)
+    starts[1:] = (rows[1:] != rows[:-1]) | (hour_dt[1:] != hour_dt[:-1] + 3600)
+    start_idx = np.flatnonzero(starts)
+    end_idx = np.append(start_idx[1:], len(rows))
+    # Пик каждого интервала — одним reduceat; час пика — первый час интервала с этим значением
+    peaks = np.maximum.reduceat(rain, start_idx)
+    interval_of = np.cumsum(starts) - 1
+    peak_hours = np.flatnonzero(rain == peaks[interval_of])
+    peak_at = peak_hours[np.unique(interval_of[peak_hours], return_index=True)[1]]
+    # Номер интервала внутри города: в карточку попадают только первые limit
+    city_rows = rows[start_idx]
+    city_first = np.ones(len(start_idx), dtype=bool)
+    city_first[1:] = city_rows[1:] != city_rows[:-1]
+    rank = np.arange(len(start_idx)) - np.maximum.accumulate(np.where(city_first, np.arange(len(start_idx)), 0))
+    for i in np.flatnonzero(rank < limit).tolist():
+        peak, at = float(peaks[i]), int(peak_at[i])
+        description = hour_description(columns['hourly'][rows[at]][cols[at]]).capitalize() if peak > 0 else "Дождь"
+        intervals[int(city_rows[i])].append((int(hour_dt[start_idx[i]]), int(hour_dt[end_idx[i] - 1]), peak, description))
+    return intervals
+
+def format_rain_interval(start_ts: int, end_ts: int, offset: int, description: str) -> str:
+    local_start = datetime.datetime.fromtimestamp(start_ts + offset, tz=datetime.timezone.utc)
+    local_end_display = datetime.datetime.fromtimestamp(end_ts + 3600 + offset, tz=datetime.timezone.utc)
+    # Часы и минуты форматируются напрямую: strftime здесь был самой дорогой операцией анализа
+    start_str = f"{local_start.hour:02d}:{local_start.minute:02d}"
+    end_time_str = f"{local_end_display.hour:02d}:{local_end_display.minute:02d}"
+    start_day_abbr = DAY_ABBREVIATIONS[local_start.weekday()]
+    if local_start.day == local_end_display.day or end_time_str == '00:00':
+        if end_time_str == '00:00': end_time_str = '24:00'
+        return f"• {start_day_abbr}, {start_str} - {end_time_str} ({description})"
+    return f"• {start_day_abbr}, {start_str} - {DAY_ABBREVIATIONS[local_end_display.weekday()]}, {end_time_str} ({description})"
+
+def daily_temperature_summaries(columns: Dict[str, Any]) -> List[Optional[str]]:
+    # Минимум/максимум на сегодня и завтра (daily[0] — текущие сутки по местному времени города)
+    lows, highs = np.rint(columns['temp_min'][:, :2]).astype(int).tolist(), np.rint(columns['temp_max'][:, :2]).astype(int).tolist()
+    summaries: List[Optional[str]] = []
+    for valid, low, high in zip(columns['daily_valid'][:, :2].tolist(), lows, highs):
+        parts = [f"{label} {low[d]}…{high[d]}°C" for d, label in enumerate(("Сегодня", "завтра")) if valid[d]]
+        summaries.append(", ".join(parts) if parts else None)
+    return summaries
+
+def hourly_sparklines(columns: Dict[str, Any], hours: int = SPARKLINE_HOURS) -> List[Optional[Dict[str, List[float]]]]:
+    # Ближайшие часы начиная с текущего. Почасовой ряд города непрерывен, поэтому окно — срез
+    # от первого подходящего часа длиной не больше hours
+    upcoming = columns['valid'] & (columns['dt'] > columns['current_dt'][:, None] - 3600)
+    firsts = upcoming.argmax(axis=1).tolist()
+    counts = np.minimum(upcoming.sum(axis=1), hours).tolist()
+    temp, pop = np.round(columns['temp'], 1), np.round(columns['pop'], 2)
+    sparklines: List[Optional[Dict[str, List[float]]]] = []
+    for i, (first, count) in enumerate(zip(firsts, counts)):
+        # Вырожденный график из пары точек не рисуем
+        sparklines.append({'temp': temp[i, first:first + count].tolist(), 'pop': pop[i, first:first + count].tolist()} if count >= 6 else None)
+    return sparklines
+
+def analyze_forecasts(batch: List[Dict]) -> List[Dict[str, Any]]:
+    columns = forecast_columns(batch)
+    intervals = rain_intervals(columns)
+    summaries = daily_temperature_summaries(columns)
+    sparklines = hourly_sparklines(columns)
+    results = []
+    for i in range(len(batch)):
+        if not columns['ok'][i]: lines = ["Прогноз недоступен"]
+        elif not intervals[i]: lines = ["Осадков не ожидается"]
+        else: lines = [format_rain_interval(start, end, columns['offset'][i], description) for start, end, _, description in intervals[i]]
+        results.append({'precipitation_lines': lines, 'daily_summary': summaries[i], 'sparkline': sparklines[i]})
+    return results
 
 
+# --- Вёрстка текста ---
+def word_width(word: str, font: ImageFont.FreeTypeFont) -> float:
+    widths = word_width_cache.setdefault(font, {})
+    width = widths.get(word)
+    if width is None:
+        width = widths[word] = font.getlength(word)
+    return width
+
+def text_width(text: str, font: ImageFont.FreeTypeFont) -> float:
+    # Ширина строки из закэшированных ширин слов и пробела (кернинг на стыках слов не учитывается)
+    words = text.split(" ")
+    return sum(word_width(word, font) for word in words) + word_width(" ", font) * (len(words) - 1)
+
 def wrap_text(text: str, font: ImageFont.FreeTypeFont, max_width: int) -> str:
+    # Один проход по словам: ширина строки накапливается, а не измеряется заново для каждого слова
     lines, words = [], text.split()
     if not words: return ""
-    current_line = words[0]
+    space = word_width(" ", font)
+    current_line, current_width = words[0], word_width(words[0], font)
     for word in words[1:]:
-        if font.getlength(current_line + " " + word) <= max_width:
+        candidate_width = current_width + space + word_width(word, font)
+        # У самой границы меряем точно, чтобы кернинг не изменил перенос
+        if abs(candidate_width - max_width) < 1:
+            candidate_width = font.getlength(current_line + " " + word)
+        if candidate_width <= max_width:
             current_line += " " + word
+            current_width = candidate_width
         else:
             lines.append(current_line)
-            current_line = word
+            current_line, current_width = word, word_width(word, font)
     lines.append(current_line)
     return "\n".join(lines)
 
-def create_weather_frame(city_name: str, weather_data: Dict, precipitation_forecast_lines: List[str], aqi_data: Optional[Tuple[int, float]]) -> Optional[Image.Image]:
-    background_path = get_random_background_image(city_name)
-    if not background_path: return None
+def layout_text_block(fixed_lines: List[str], wrapped_lines: List[str], font: ImageFont.FreeTypeFont, max_width: int,
+                      spacing: int = 10) -> Tuple[str, Tuple[int, int, int, int]]:
+    # Переносит строки wrapped_lines по ширине и за одно измерение возвращает текст блока и его рамку
+    text = "\n".join(fixed_lines + [wrap_text(line, font, max_width) for line in wrapped_lines])
+    bbox = ImageDraw.Draw(Image.new("L", (1, 1))).multiline_textbbox((0, 0), text, font=font, spacing=spacing)
+    return text, bbox
+
+def get_plaque_mask(width: int, height: int, radius: int, alpha: int) -> Image.Image:
+    # Маска полупрозрачной плашки со скруглёнными углами, рисуется один раз на размер
+    key = (width, height, radius, alpha)
+    mask = plaque_mask_cache.get(key)
+    if mask is None:
+        mask = Image.new("L", (width + 1, height + 1), 0)
+        round_rectangle(ImageDraw.Draw(mask), (0, 0, width, height), radius, alpha)
+        plaque_mask_cache[key] = mask
+    return mask
+
+def format_weather_card_lines(city_name: str, weather_data: Dict, precipitation_forecast_lines: List[str], aqi_data: Optional[Tuple[int, float]],
+                              daily_summary: Optional[str] = None) -> List[str]:
+    current = weather_data['current']
+    offset = weather_data.get('timezone_offset', 0)
+    local_dt = datetime.datetime.fromtimestamp(current['dt'], tz=datetime.timezone.utc) + datetime.timedelta(seconds=offset)
+    day_of_week_str = DAYS_OF_WEEK_ACCUSATIVE.get(local_dt.weekday(), '')
+    new_title = f"Погода на {day_of_week_str} в г. {city_name}\n"
+    if weather_data.get('stale_since'):
+        # API был недоступен — показываются последние полученные данные
+        stale_local = datetime.datetime.fromtimestamp(weather_data['stale_since'], tz=datetime.timezone.utc) + datetime.timedelta(seconds=offset)
+        new_title = f"Погода на {day_of_week_str} в г. {city_name}\n(данные от {stale_local:%d.%m %H:%M}, сервис недоступен)\n"
+    
+    weather_description_and_humidity = f"{current['weather'][0]['description'].capitalize()}, влажность: {current['humidity']}%"
+
+    # Формирование строк AQI и PM2.5 отдельно
+    aqi_str = "Загрязнение воздуха: Нет данных"
+    pm_str = "PM2.5: Нет данных"
+    if aqi_data is not None:
+        aqi_index, pm25_val = aqi_data
+        desc = AQI_INFO.get(aqi_index, "Неизвестно")
+        aqi_str = f"Загрязнение воздуха: {aqi_index} из 5 ({desc})"
+        pm_str = f"PM2.5: {pm25_val:.1f} мкг/м³"
+
+    return [
+        new_title,
+        f"Температура: {current['temp']:.1f}°C (ощущ. {current['feels_like']:.1f}°C)",
+        *([daily_summary] if daily_summary else []),
+        weather_description_and_humidity,
+        aqi_str,
+        pm_str, 
+        f"Ветер: {get_wind_direction_abbr(current['wind_deg'])}, {current['wind_speed']:.1f} м/с",
+    ]
+
+def canonical_hash(data: Any) -> str:
+    return hashlib.sha256(json.dumps(data, sort_keys=True, ensure_ascii=False, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+def weather_card_spec(city_name: str, weather_data: Dict, precipitation_forecast_lines: List[str], aqi_data: Optional[Tuple[int, float]],
+                      forecast: Optional[Dict[str, Any]] = None, background_index: Optional[Dict[str, Dict[str, Any]]] = None) -> Optional[Dict[str, Any]]:
+    # Всё, от чего зависит картинка карточки. Фон выбирается случайно, но с зерном из отображаемых значений:
+    # пока значения не меняются, карточка (и её ключ в кэше) остаются прежними.
+    # forecast — результат analyze_forecasts для города: сводка min/max по дням и данные почасового графика.
+    # background_index — индекс кэша фонов, общий для всех городов запуска; новые хэши дописываются в него,
+    # сохраняет его вызывающий (update_background_index).
+    forecast = forecast or {}
     try:
-        img = Image.open(background_path).convert("RGB")
-        target_width = 800
-        w_percent = (target_width / float(img.size[0]))
-        h_size = int((float(img.size[1]) * float(w_percent)))
-        img = img.resize((target_width, h_size), Image.Resampling.LANCZOS)
+        spec = {
+            'version': RENDER_CACHE_VERSION,
+            'city_name': city_name,
+            'main_info_lines': format_weather_card_lines(city_name, weather_data, precipitation_forecast_lines, aqi_data, forecast.get('daily_summary')),
+            'forecast_lines': list(precipitation_forecast_lines),
+            'sparkline': forecast.get('sparkline'),
+            'width': BACKGROUND_TARGET_WIDTH,
+            'font_size': int(BACKGROUND_TARGET_WIDTH / 22),
+        }
+        background_path = get_random_background_image(city_name, seed=canonical_hash(spec))
+        if not background_path: return None
+        spec['background_path'] = background_path
+        spec['background_sha256'] = get_background_hash(background_path, load_background_index() if background_index is None else background_index)
+        spec['key'] = canonical_hash(spec)
+        return spec
+    except Exception as e:
+        logger.error(f"Ошибка при подготовке кадра для {city_name}: {e}")
+        return None
+
+def render_weather_card(spec: Dict[str, Any]) -> Optional[Image.Image]:
+    city_name = spec['city_name']
+    try:
+        img = Image.fromarray(get_background_array(spec['background_path'], spec['width']))
         
-        current = weather_data['current']
         width, height = img.size
-        draw = ImageDraw.Draw(img)
         
         plaque_width, padding, border_radius = int(width * 0.9), int(width * 0.04), int(width * 0.03)
-        font_size = int(width / 22)
-        font = get_font(font_size)
-        
-        offset = weather_data.get('timezone_offset', 0)
-        local_dt = datetime.datetime.fromtimestamp(current['dt'], tz=datetime.timezone.utc) + datetime.timedelta(seconds=offset)
-        day_of_week_str = DAYS_OF_WEEK_ACCUSATIVE.get(local_dt.weekday(), '')
-        new_title = f"Погода на {day_of_week_str} в г. {city_name}\n"
-        
-        weather_description_and_humidity = f"{current['weather'][0]['description'].capitalize()}, влажность: {current['humidity']}%"
-
-        # Формирование строк AQI и PM2.5 отдельно
-        aqi_str = "Загрязнение воздуха: Нет данных"
-        pm_str = "PM2.5: Нет данных"
-        if aqi_data is not None:
-            aqi_index, pm25_val = aqi_data
-            desc = AQI_INFO.get(aqi_index, "Неизвестно")
-            aqi_str = f"Загрязнение воздуха: {aqi_index} из 5 ({desc})"
-            pm_str = f"PM2.5: {pm25_val:.1f} мкг/м³"
-
-        main_info_lines = [
-            new_title,
-            f"Температура: {current['temp']:.1f}°C (ощущ. {current['feels_like']:.1f}°C)",
-            weather_description_and_humidity,
-            aqi_str,
-            pm_str, 
-            f"Ветер: {get_wind_direction_abbr(current['wind_deg'])}, {current['wind_speed']:.1f} м/с",
-        ]
-        
-        final_forecast_lines = []
-        for line in precipitation_forecast_lines:
-            wrapped_line = wrap_text(line, font, plaque_width - padding * 2)
-            final_forecast_lines.append(wrapped_line)
-
-        text_lines = main_info_lines + ["\nПрогноз осадков:"] + final_forecast_lines
-        weather_text = "\n".join(text_lines)
-        
-        bbox = draw.textbbox((0, 0), weather_text, font=font, spacing=10)
-        text_h = bbox[3] - bbox[1]
-        plaque_h = text_h + 2 * padding
+        chart_h = int(width * SPARKLINE_HEIGHT_FACTOR) if spec.get('sparkline') else 0
+        # Если текст с графиком не помещается по высоте фона, шрифт уменьшается до минимального
+        font_size = spec['font_size']
+        while True:
+            font = get_font(font_size)
+            weather_text, bbox = layout_text_block(spec['main_info_lines'] + ["\nПрогноз осадков:"], spec['forecast_lines'],
+                                                   font, plaque_width - padding * 2, spacing=10)
+            text_h = bbox[3] - bbox[1]
+            plaque_h = text_h + 2 * padding + (chart_h + padding if chart_h else 0)
+            if plaque_h <= height * 0.96 or font_size <= MIN_FONT_SIZE: break
+            # Высота текста почти пропорциональна кеглю: сразу прыгаем к оценке, дальше уточняем по 2 пт
+            fixed_h = plaque_h - text_h
+            font_size = max(MIN_FONT_SIZE, min(font_size - 2, int(font_size * (height * 0.96 - fixed_h) / text_h)))
         
         plaque_x = (width - plaque_width) // 2
         plaque_y = (height - plaque_h) // 2
         
-        plaque_img = Image.new('RGBA', img.size, (0,0,0,0))
-        plaque_draw = ImageDraw.Draw(plaque_img)
-        round_rectangle(plaque_draw, (plaque_x, plaque_y, plaque_x + plaque_width, plaque_y + plaque_h), border_radius, (0, 0, 0, 160))
-        img.paste(plaque_img, (0,0), plaque_img)
+        img.paste((0, 0, 0), (plaque_x, plaque_y), get_plaque_mask(plaque_width, plaque_h, border_radius, 160))
         
         draw = ImageDraw.Draw(img)
-        text_bbox_final = draw.textbbox((plaque_x, plaque_y), weather_text, font=font, spacing=10)
-        text_w = text_bbox_final[2] - text_bbox_final[0]
+        text_w = bbox[2] - bbox[0]
         text_x = plaque_x + (plaque_width - text_w) // 2
         draw.multiline_text((text_x, plaque_y + padding), weather_text, fill=(255, 255, 255), font=font, spacing=10, align="center")
+        if chart_h:
+            draw_sparkline(draw, spec['sparkline'], (plaque_x + padding, plaque_y + padding * 2 + text_h,
+                                                     plaque_x + plaque_width - padding, plaque_y + padding * 2 + text_h + chart_h),
+                           get_font(max(10, font_size * 2 // 3)))
         
         return img
     except Exception as e:
         logger.error(f"Ошибка при создании кадра для {city_name}: {e}")
         return None
 
-def create_weather_video(frames: List[Image.Image], output_path: str = "weather_report.mp4") -> str:
-    if not frames: return ""
+def draw_sparkline(draw: ImageDraw.ImageDraw, sparkline: Dict[str, List[float]], box: Tuple[int, int, int, int], font: ImageFont.FreeTypeFont):
+    # Почасовой график: столбики — вероятность осадков (полная высота = 100%), линия — температура.
+    # Координаты всех точек считаются одним векторным выражением, подписи — min/max температуры слева.
+    left, top, right, bottom = box
+    temp, pop = np.asarray(sparkline['temp']), np.asarray(sparkline['pop'])
+    label_w = int(max(text_width(f"{value:.0f}°", font) for value in (temp.min(), temp.max()))) + 8
+    left += label_w
+    step = (right - left) / len(temp)
+    xs = left + step * (np.arange(len(temp)) + 0.5)
+    bar_tops = bottom - pop * (bottom - top)
+    for x, bar_top, p in zip(xs, bar_tops, pop):
+        if p > 0: draw.rectangle((x - step * 0.35, bar_top, x + step * 0.35, bottom), fill=(80, 150, 255) if p > RAIN_POP_THRESHOLD else (60, 90, 140))
+    span = max(temp.max() - temp.min(), 1.0)
+    line_top, line_bottom = top + font.size // 2, bottom - font.size // 2
+    ys = line_bottom - (temp - temp.min()) / span * (line_bottom - line_top)
+    draw.line(list(zip(xs.tolist(), ys.tolist())), fill=(255, 200, 80), width=max(3, font.size // 8), joint="curve")
+    draw.text((left - 6, line_top), f"{temp.max():.0f}°", fill=(255, 255, 255), font=font, anchor="rm")
+    draw.text((left - 6, line_bottom), f"{temp.min():.0f}°", fill=(255, 255, 255), font=font, anchor="rm")
+
+def load_or_render_card(spec: Dict[str, Any]) -> Optional[Image.Image]:
+    cache_file = os.path.join(RENDER_CACHE_DIR, f"{spec['key']}.npy")
+    try:
+        if os.path.exists(cache_file):
+            img = Image.fromarray(np.load(cache_file))
+            os.utime(cache_file)  # время последнего использования — для вытеснения по возрасту
+            img.info['render_cache_hit'] = True  # info переживает передачу из процесса-воркера
+            logger.info(f"Карточка {spec['city_name']} не изменилась, взята из кэша.")
+            return img
+    except (OSError, ValueError) as e:
+        logger.warning(f"Не удалось прочитать карточку из кэша {cache_file}: {e}")
+    img = render_weather_card(spec)
+    if img is not None:
+        try:
+            os.makedirs(RENDER_CACHE_DIR, exist_ok=True)
+            tmp_path = f"{cache_file}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.asarray(img))
+            os.replace(tmp_path, cache_file)
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить карточку в кэш: {e}")
+    return img
+
+def frame_to_array(frame: Image.Image, size: Tuple[int, int], out: Optional[np.ndarray] = None) -> np.ndarray:
+    # Карточка как массив (H, W, 3) uint8 заданного размера (ширина, высота)
+    if frame.size != size: frame = frame.resize(size, Image.Resampling.LANCZOS)
+    if out is None: out = np.empty((size[1], size[0], 3), dtype=np.uint8)
+    out[...] = np.asarray(frame.convert("RGB"))
+    return out
+
+def allocate_transition_buffers(frame_shape: Tuple[int, ...], batch_size: int = TRANSITION_BATCH_SIZE) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Выходной буфер uint8 и два рабочих буфера uint16 для арифметики с фиксированной точкой
+    shape = (batch_size,) + tuple(frame_shape)
+    return np.empty(shape, dtype=np.uint8), np.empty(shape, dtype=np.uint16), np.empty(shape, dtype=np.uint16)
+
+def iter_transition_frames(current: np.ndarray, nxt: np.ndarray, steps: int, kind: str = "crossfade",
+                           buffers: Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]] = None) -> Iterator[np.ndarray]:
+    # Отдаёт пачки кадров перехода (шаги 1..steps) — это представления одного и того же буфера,
+    # их нужно использовать до следующей итерации
+    if kind not in TRANSITION_TYPES: raise ValueError(f"Неизвестный тип перехода: {kind}")
+    if buffers is None: buffers = allocate_transition_buffers(current.shape)
+    out, scratch_a, scratch_b = buffers
+    batch_size, width = out.shape[0], current.shape[1]
+    # Вес следующего кадра в 1/256 долях и смещение границы в пикселях для каждого шага
+    weights = np.rint(np.arange(1, steps + 1) * 256 / steps).astype(np.uint16)
+    offsets = np.rint(np.arange(1, steps + 1) * width / steps).astype(np.intp)
+    for start in range(0, steps, batch_size):
+        n = min(batch_size, steps - start)
+        batch = out[:n]
+        if kind == "crossfade":
+            w = weights[start:start + n].reshape(n, 1, 1, 1)
+            a, b = scratch_a[:n], scratch_b[:n]
+            np.multiply(current, 256 - w, out=a)
+            np.multiply(nxt, w, out=b)
+            a += b
+            a += 128
+            a >>= 8
+            np.copyto(batch, a, casting="unsafe")
+        else:
+            for j, offset in enumerate(offsets[start:start + n]):
+                if kind == "slide":
+                    batch[j, :, :width - offset] = current[:, offset:]
+                    batch[j, :, width - offset:] = nxt[:, :offset]
+                else:
+                    batch[j, :, :offset] = nxt[:, :offset]
+                    batch[j, :, offset:] = current[:, offset:]
+        yield batch
+
+def hold_frame_timeline_filter(hold_frames: int, steps: int) -> str:
+    # На вход ffmpeg идут только уникальные кадры: карточка, затем steps кадров перехода.
+    # setpts возвращает каждому кадру его место на исходной шкале fps (в единицах 1/fps),
+    # так что карточка показывается hold_frames интервалов, а переход — как раньше
+    k, segment = steps + 1, hold_frames + steps
+    return f"setpts='floor(N/{k})*{segment}+if(eq(mod(N,{k}),0),0,{hold_frames - 1}+mod(N,{k}))'"
+
+def _encode_frames(output_path: str, params: Dict[str, Any], filled: queue.Queue, free: queue.Queue,
+                   stats: Dict[str, float], errors: List[Exception]):
+    # Поток кодировщика: забирает (буфер, число повторов) из очереди и пишет сырые кадры в stdin ffmpeg.
+    # Очередь вычитывается до конца даже после ошибки, чтобы производитель не завис на пустом пуле.
+    # encode_sec — только запуск ffmpeg, запись кадров и закрытие: ожидание карточек из пула рендера в него не входит.
+    writer = None
+    started = time.perf_counter()
+    try:
+        writer = imageio.get_writer(output_path, **params)
+    except Exception as e:
+        errors.append(e)
+    stats['encode_sec'] += time.perf_counter() - started
+    while True:
+        wait_started = time.perf_counter()
+        item = filled.get()
+        stats['encoder_wait_sec'] += time.perf_counter() - wait_started
+        if item is None: break
+        buffer, repeat = item
+        if not errors:
+            started = time.perf_counter()
+            try:
+                for _ in range(repeat): writer.append_data(buffer)
+                stats['frames_written'] += repeat
+            except Exception as e:
+                errors.append(e)
+            stats['encode_sec'] += time.perf_counter() - started
+        free.put(buffer)
+    if writer is not None:
+        started = time.perf_counter()
+        try: writer.close()
+        except Exception as e: errors.append(e)
+        stats['encode_sec'] += time.perf_counter() - started
+
+def create_weather_video(frames: Iterable[Image.Image], output_path: str = "weather_report.mp4", transition: str = TRANSITION_TYPE,
+                         dedupe_hold_frames: bool = VIDEO_DEDUPE_HOLD_FRAMES, queue_size: int = VIDEO_QUEUE_SIZE,
+                         stats: Optional[Dict[str, float]] = None, profile: str = VIDEO_ENCODING_PROFILE,
+                         expected_cards: Optional[int] = None) -> str:
+    # Карточки читаются из итератора по мере готовности: в памяти одновременно только первая, текущая
+    # и следующая карточки плюс пул из queue_size кадров, сколько бы ни было городов и шагов перехода.
+    # Рендер и переходы идут в вызывающем потоке, кодирование — в отдельном, этапы перекрываются.
+    frames = iter(frames)
+    first_card = next(frames, None)
+    if first_card is None:
+        logger.error("Не удалось создать ни одного кадра для видео.")
+        return ""
     
     # --- НАСТРОЙКИ ---
-    fps = 20
-    hold_duration_sec = 5
-    steps = 15
+    fps = VIDEO_FPS
+    hold_duration_sec = VIDEO_HOLD_DURATION_SEC
+    steps = TRANSITION_STEPS
     # --- КОНЕЦ НАСТРОЕК ---
     
     hold_frames = fps * hold_duration_sec
+    if stats is None: stats = {}
+    stats.update({'frames_written': 0, 'producer_stall_sec': 0.0, 'encoder_wait_sec': 0.0, 'encode_sec': 0.0,
+                  'max_queue_depth': 0, 'avg_queue_depth': 0.0, 'queue_size': queue_size})
     try:
+        size = first_card.size
+        # Длительность и число кадров на входе ffmpeg известны заранее из числа карточек — по ним выбирается профиль
+        cards = expected_cards or len(CITIES)
+        expected_duration = (cards * (hold_frames + steps) + (1 if dedupe_hold_frames else 0)) / fps
+        expected_frames = cards * ((1 if dedupe_hold_frames else hold_frames) + steps) + (1 if dedupe_hold_frames else 0)
+        settings = choose_encoding_settings(profile, size, expected_duration, expected_frames)
+        stats['encoding'] = settings
         params = {
             'fps': fps,
             'codec': 'libx264',
             'pixelformat': 'yuv420p',
             'output_params': [
                 '-an',
-                '-preset', 'slow',
+                '-preset', settings['preset'],
                 '-tune', 'animation',
-                '-crf', '28'
+                '-crf', str(settings['crf'])
             ]
         }
+        if settings.get('maxrate_kbps'):
+            # Режим auto: CRF с ограничением битрейта, чтобы бюджет размера соблюдался и при ошибке прогноза
+            params['output_params'] += ['-maxrate', f"{settings['maxrate_kbps']}k", '-bufsize', f"{settings['maxrate_kbps'] * 2}k"]
+        hold_frames_total = hold_frames
         
-        with imageio.get_writer(output_path, **params) as writer:
-            for i in range(len(frames)):
-                current, nxt = frames[i], frames[(i + 1) % len(frames)]
-                main_frame = np.array(add_watermark(current.copy()))
-                for _ in range(hold_frames): writer.append_data(main_frame)
-                for step in range(1, steps + 1):
-                    blended = np.array(add_watermark(Image.blend(current, nxt, alpha=step/steps)))
-                    writer.append_data(blended)
-        logger.info(f"Видео MP4 создано и оптимизировано: {output_path}")
+        first = frame_to_array(first_card, size)
+        if dedupe_hold_frames:
+            # Фильтр масштабирования до кратности макроблоку добавляем сами, в одну цепочку с setpts
+            width, height = size
+            block = VIDEO_MACRO_BLOCK_SIZE
+            filters = [hold_frame_timeline_filter(hold_frames, steps)]
+            if width % block or height % block:
+                filters.append(f"scale={-(-width // block) * block}:{-(-height // block) * block}")
+            params['macro_block_size'] = 1
+            params['output_params'] = ['-vf', ",".join(filters), '-fps_mode', 'vfr'] + params['output_params']
+            hold_frames = 1
+        buffers = allocate_transition_buffers(first.shape)
+
+        free: queue.Queue = queue.Queue()
+        for _ in range(max(1, queue_size)): free.put(np.empty_like(first))
+        filled: queue.Queue = queue.Queue()
+        errors: List[Exception] = []
+        encoder = threading.Thread(target=_encode_frames, args=(output_path, params, filled, free, stats, errors),
+                                   name="video-encoder", daemon=True)
+        encoder.start()
+        depth_total, depth_samples = 0, 0
+
+        def emit(frame: np.ndarray, repeat: int = 1):
+            nonlocal depth_total, depth_samples
+            if errors: raise errors[0]
+            wait_started = time.perf_counter()
+            buffer = free.get()
+            stats['producer_stall_sec'] += time.perf_counter() - wait_started
+            np.copyto(buffer, frame)
+            filled.put((buffer, repeat))
+            depth = filled.qsize()
+            depth_total, depth_samples = depth_total + depth, depth_samples + 1
+            stats['max_queue_depth'] = max(stats['max_queue_depth'], depth)
+
+        try:
+            # Следующая карточка пишется попеременно в один из двух буферов, текущая остаётся нетронутой
+            card_buffers = (np.empty_like(first), np.empty_like(first))
+            current, slot, pair_index = first, 0, 0
+            while True:
+                next_card = next(frames, None)
+                if next_card is None:
+                    nxt = first
+                else:
+                    nxt = frame_to_array(next_card, size, card_buffers[slot])
+                    slot ^= 1
+                np.copyto(buffers[0][0], current)
+                emit(apply_watermark(buffers[0][0]), hold_frames)
+                with metrics.span('transition', index=pair_index, kind=transition):
+                    for batch in iter_transition_frames(current, nxt, steps, transition, buffers):
+                        apply_watermark(batch)
+                        for frame in batch: emit(frame)
+                pair_index += 1
+                if next_card is None: break
+                current = nxt
+            if dedupe_hold_frames:
+                # Замыкающий кадр задаёт длительность последнего кадра перехода (в VFR она иначе теряется)
+                np.copyto(buffers[0][0], first)
+                emit(apply_watermark(buffers[0][0]))
+        finally:
+            filled.put(None)
+            encoder.join()
+        stats['avg_queue_depth'] = depth_total / depth_samples if depth_samples else 0.0
+        if errors: raise errors[0]
+        stats['output_bytes'] = os.path.getsize(output_path)
+        stats['duration_sec'] = (pair_index * (hold_frames_total + steps) + (1 if dedupe_hold_frames else 0)) / fps
+        try:
+            record_encoding_calibration(size, settings, stats)
+        except Exception as e:
+            # Калибровка — лишь статистика для режима auto: её сбой не должен отменять готовое видео
+            logger.warning(f"Не удалось обновить калибровку кодирования: {e}")
+        logger.info(f"Видео MP4 создано и оптимизировано: {output_path} (кадров: {stats['frames_written']}, "
+                    f"{settings['preset']}/CRF {settings['crf']}: {stats['output_bytes'] / 1024:.0f} КБ за {stats['encode_sec']:.1f} с, "
+                    f"ожидание кодировщика: {stats['producer_stall_sec']:.2f} с, простой кодировщика: {stats['encoder_wait_sec']:.2f} с, "
+                    f"макс. глубина очереди: {stats['max_queue_depth']}/{queue_size})")
         return output_path
     except Exception as e:
         logger.error(f"Ошибка при создании MP4: {e}")
+        if os.path.exists(output_path): os.remove(output_path)
         return ""
 
-def save_message_id(message_id: int):
-    messages_list = []
-    if os.path.exists(MESSAGE_IDS_FILE) and os.path.getsize(MESSAGE_IDS_FILE) > 0:
-        try:
-            with open(MESSAGE_IDS_FILE, 'r') as f:
-                loaded_data = yaml.safe_load(f)
-                if isinstance(loaded_data, list):
-                    messages_list = loaded_data
-                else:
-                    logger.warning(f"Файл {MESSAGE_IDS_FILE} содержит некорректные данные (не список), начинаем с чистого листа.")
-        except yaml.YAMLError:
-            logger.warning(f"Файл {MESSAGE_IDS_FILE} поврежден, начинаем с чистого листа.")
-        except Exception as e:
-            logger.error(f"Ошибка при чтении {MESSAGE_IDS_FILE}: {e}, начинаем с чистого листа.")
+# --- Профили кодирования видео ---
+def _valid_calibration_entry(key: str, entry: Any) -> bool:
+    preset, _, crf = key.partition('/')
+    return (preset in PRESET_TIME_FACTORS and crf.isdigit() and isinstance(entry, dict)
+            and all(isinstance(entry.get(field), (int, float)) and entry[field] > 0 for field in ('bytes_per_sec', 'sec_per_frame')))
 
-    new_message_entry = {'message_id': message_id, 'sent_at': datetime.datetime.now(datetime.timezone.utc).isoformat()}
-    
-    if not any(item.get('message_id') == message_id for item in messages_list):
-        messages_list.append(new_message_entry)
-        logger.info(f"Добавлен ID {message_id} в список для сохранения.")
+def load_encoding_calibration() -> Dict[str, Dict[str, Dict[str, float]]]:
+    # Повреждённые записи отбрасываются (и исчезнут из файла при следующей записи); без записей режим auto
+    # кодирует профилем balanced
+    table, valid = read_json(ENCODING_CALIBRATION_FILE, {}), {}
+    for resolution, entries in table.items():
+        if not isinstance(entries, dict): continue
+        valid[resolution] = {key: {**entry, 'runs': entry.get('runs') if isinstance(entry.get('runs'), int) else 1}
+                             for key, entry in entries.items() if _valid_calibration_entry(key, entry)}
+    dropped = sum(len(entries) if isinstance(entries, dict) else 1 for entries in table.values()) - sum(map(len, valid.values()))
+    if dropped: logger.warning(f"В {ENCODING_CALIBRATION_FILE} пропущено повреждённых записей калибровки: {dropped}.")
+    return valid
+
+def record_encoding_calibration(size: Tuple[int, int], settings: Dict[str, Any], stats: Dict[str, Any]):
+    # Таблица: разрешение -> "пресет/crf" -> байт на секунду видео и секунд кодирования на входной кадр.
+    # Замеры сглаживаются (EMA), чтобы один шумный запуск не перевешивал историю. Если файл упёрся
+    # в потолок битрейта, размер определяется потолком, а не CRF: такой замер записывается с флагом capped —
+    # время кодирования в нём верное, а размер — лишь нижняя граница.
+    if not stats.get('frames_written') or not stats.get('duration_sec'): return
+    capped = bool(settings.get('maxrate_kbps')) and stats['output_bytes'] > 0.9 * settings['maxrate_kbps'] * 1000 / 8 * stats['duration_sec']
+    table = load_encoding_calibration()
+    entries = table.setdefault(f"{size[0]}x{size[1]}", {})
+    key = f"{settings['preset']}/{settings['crf']}"
+    bytes_per_sec, sec_per_frame = stats['output_bytes'] / stats['duration_sec'], stats['encode_sec'] / stats['frames_written']
+    entry = entries.get(key)
+    if not entry:
+        entries[key] = {'bytes_per_sec': bytes_per_sec, 'sec_per_frame': sec_per_frame, 'runs': 1, 'capped': capped}
+    else:
+        entry['sec_per_frame'] = entry['sec_per_frame'] * 0.5 + sec_per_frame * 0.5
+        if capped:
+            # Нижняя граница может только поднять оценку размера
+            entry['bytes_per_sec'] = max(entry['bytes_per_sec'], bytes_per_sec)
+        elif entry.get('capped'):
+            # Первый замер без потолка заменяет границу целиком
+            entry['bytes_per_sec'], entry['capped'] = bytes_per_sec, False
+        else:
+            entry['bytes_per_sec'] = entry['bytes_per_sec'] * 0.5 + bytes_per_sec * 0.5
+        entry['runs'] += 1
+    try:
+        write_json_atomic(ENCODING_CALIBRATION_FILE, table, indent=1)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить таблицу калибровки кодирования: {e}")
+
+def _entry_bytes_per_sec(entry: Dict[str, Any]) -> float:
+    # Размер из замера с флагом capped — нижняя граница (см. CAPPED_SIZE_FACTOR)
+    return entry['bytes_per_sec'] * (CAPPED_SIZE_FACTOR if entry.get('capped') else 1.0)
+
+def predict_encoding(entries: Dict[str, Dict[str, Any]], preset: str, crf: int) -> Optional[Tuple[float, float]]:
+    # (байт/с, с/кадр) для сочетания: измеренное — как есть, иначе пересчёт от самого проверенного замера
+    # (замеры без потолка предпочтительнее)
+    if f"{preset}/{crf}" in entries:
+        entry = entries[f"{preset}/{crf}"]
+        return _entry_bytes_per_sec(entry), entry['sec_per_frame']
+    known = [(key.split('/'), entry) for key, entry in entries.items() if key.split('/')[0] in PRESET_TIME_FACTORS]
+    if not known: return None
+    (ref_preset, ref_crf), ref = max(known, key=lambda item: (not item[1].get('capped'), item[1]['runs'], -abs(int(item[0][1]) - crf)))
+    bytes_per_sec = _entry_bytes_per_sec(ref) * 2 ** ((int(ref_crf) - crf) / 6) * PRESET_SIZE_FACTORS[preset] / PRESET_SIZE_FACTORS[ref_preset]
+    return bytes_per_sec, ref['sec_per_frame'] * PRESET_TIME_FACTORS[preset] / PRESET_TIME_FACTORS[ref_preset]
+
+def choose_encoding_settings(profile: str, size: Tuple[int, int], duration_sec: float, input_frames: int) -> Dict[str, Any]:
+    if profile != "auto":
+        if profile not in ENCODING_PROFILES:
+            logger.warning(f"Неизвестный профиль кодирования {profile}, используется balanced.")
+            profile = "balanced"
+        return {'profile': profile, **ENCODING_PROFILES[profile]}
+    # Лучшее качество (минимальный CRF), укладывающееся в оба бюджета; при равном CRF — самый быстрый пресет.
+    # Без калибровки для этого разрешения — профиль balanced, его замер станет точкой отсчёта.
+    maxrate_kbps = max(1, int(VIDEO_TARGET_BYTES * 8 / 1000 / duration_sec))
+    entries = load_encoding_calibration().get(f"{size[0]}x{size[1]}", {})
+    if not entries:
+        settings = {'profile': 'auto', **ENCODING_PROFILES["balanced"], 'maxrate_kbps': maxrate_kbps}
+        logger.info(f"Кодирование auto: нет замеров, {settings['preset']}/CRF {settings['crf']} с потолком {maxrate_kbps} кбит/с.")
+        return settings
+    # (crf, с/кадр, пресет, ожидаемый размер, ожидаемое время) для всех сочетаний
+    predictions = []
+    for crf in AUTO_CRF_RANGE:
+        for preset in AUTO_PRESETS:
+            bytes_per_sec, sec_per_frame = predict_encoding(entries, preset, crf)
+            predictions.append((crf, sec_per_frame, preset, bytes_per_sec * duration_sec, sec_per_frame * input_frames))
+    in_time = [p for p in predictions if p[4] <= VIDEO_ENCODE_BUDGET_SEC]
+    candidates = [p for p in in_time if p[3] <= VIDEO_TARGET_BYTES]
+    if candidates:
+        choice, note = min(candidates), ""
+    elif not in_time:
+        # Не укладывается по времени ни одно сочетание: самый быстрый пресет, CRF — лучший из влезающих в размер
+        fastest_preset = min(predictions, key=lambda p: p[1])[2]
+        options = [p for p in predictions if p[2] == fastest_preset]
+        fitting = [p for p in options if p[3] <= VIDEO_TARGET_BYTES]
+        choice = min(fitting) if fitting else min(options, key=lambda p: p[3])
+        note = " — бюджет времени недостижим, выбран самый быстрый пресет"
     else:
-        logger.warning(f"ID {message_id} уже присутствует в списке, не добавляем повторно.")
+        # По времени есть варианты, но ни один не влезает в размер: самый маленький файл из укладывающихся во время
+        choice = min(in_time, key=lambda p: (p[3], p[1]))
+        note = " — бюджет размера недостижим, выбран самый маленький файл"
+    crf, _, preset, predicted_bytes, predicted_sec = choice
+    logger.info(f"Кодирование auto: {preset}/CRF {crf}, ожидается {predicted_bytes / 1024:.0f} КБ за {predicted_sec:.1f} с "
+                f"(бюджет {VIDEO_TARGET_BYTES / 1024:.0f} КБ, {VIDEO_ENCODE_BUDGET_SEC:g} с){note}.")
+    return {'profile': 'auto', 'preset': preset, 'crf': crf, 'maxrate_kbps': maxrate_kbps}
 
+def save_message_id(message_id: int, chat_id: Optional[str] = None):
     try:
-        with open(MESSAGE_IDS_FILE, 'w') as f:
-            yaml.dump(messages_list, f, default_flow_style=False)
-        logger.info(f"Файл {MESSAGE_IDS_FILE} успешно обновлен.")
+        with open_message_store() as store:
+            if store.add(str(chat_id or ''), message_id, datetime.datetime.now(datetime.timezone.utc)):
+                logger.info(f"ID {message_id} сохранён для последующего удаления.")
+            else:
+                logger.warning(f"ID {message_id} уже присутствует в хранилище, не добавляем повторно.")
     except Exception as e:
-        logger.error(f"ОШИБКА: Не удалось записать в {MESSAGE_IDS_FILE}: {e}")
+        logger.error(f"ОШИБКА: Не удалось сохранить ID {message_id}: {e}")
+
+# --- Кэш фоновых изображений ---
+def _background_index_path() -> str:
+    return os.path.join(BACKGROUND_CACHE_DIR, "index.json")
+
+def load_background_index() -> Dict[str, Dict[str, Any]]:
+    index = read_json(_background_index_path(), {})
+    return {path: entry for path, entry in index.items() if isinstance(entry, dict)}
+
+def save_background_index(index: Dict[str, Dict[str, Any]]):
+    write_json_atomic(_background_index_path(), index, ensure_ascii=False, indent=1, sort_keys=True)
+
+def update_background_index(entries: Dict[str, Dict[str, Any]]):
+    # Индекс могли обновить параллельные воркеры рендера — перечитываем и дописываем только свои записи
+    if not entries: return
+    try: save_background_index({**load_background_index(), **entries})
+    except OSError as e: logger.warning(f"Не удалось сохранить индекс кэша фонов: {e}")
+
+def file_content_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def get_background_hash(path: str, index: Dict[str, Dict[str, Any]]) -> str:
+    # Файл перехэшируется только если изменились его размер или время модификации
+    stat = os.stat(path)
+    entry = index.get(path)
+    if entry and entry.get('size') == stat.st_size and entry.get('mtime_ns') == stat.st_mtime_ns:
+        return entry['sha256']
+    content_hash = file_content_hash(path)
+    index[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': content_hash}
+    return content_hash
+
+def _background_cache_file(content_hash: str, target_width: int) -> str:
+    return os.path.join(BACKGROUND_CACHE_DIR, f"{content_hash}_{target_width}.npy")
+
+def scale_background(path: str, target_width: int) -> np.ndarray:
+    img = Image.open(path)
+    # JPEG декодируется сразу в уменьшенном масштабе (draft), дальше — LANCZOS до точной ширины
+    h_size = int(img.size[1] * (target_width / float(img.size[0])))
+    img.draft("RGB", (target_width, h_size))
+    img = img.convert("RGB").resize((target_width, h_size), Image.Resampling.LANCZOS)
+    return np.asarray(img)
+
+def get_background_array(path: str, target_width: int = BACKGROUND_TARGET_WIDTH, index: Optional[Dict[str, Dict[str, Any]]] = None) -> np.ndarray:
+    # Готовый к композитингу фон (H, W, 3) uint8; из кэша — через memory-map, без декодирования JPEG
+    own_index = index is None
+    if own_index: index = load_background_index()
+    known = dict(index.get(path, {}))
+    cache_file = _background_cache_file(get_background_hash(path, index), target_width)
+    try:
+        if os.path.exists(cache_file):
+            return np.load(cache_file, mmap_mode='r')
+        array = scale_background(path, target_width)
+        os.makedirs(BACKGROUND_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_path, cache_file)
+        logger.info(f"Фон {path} добавлен в кэш ({target_width}px).")
+        return array
+    except (OSError, ValueError) as e:
+        logger.warning(f"Кэш фонов недоступен для {path}: {e}")
+        return scale_background(path, target_width)
+    finally:
+        if own_index and index.get(path) != known: update_background_index({path: index[path]})
+
+def refresh_background_cache(target_width: int = BACKGROUND_TARGET_WIDTH) -> Tuple[int, int]:
+    # Инкрементально достраивает кэш для новых/изменённых фото и удаляет записи, на которые больше нет ссылок
+    # или которые построены для другой ширины
+    index = load_background_index()
+    sources = []
+    if os.path.isdir(BACKGROUNDS_FOLDER):
+        for city_name in sorted(os.listdir(BACKGROUNDS_FOLDER)):
+            city_folder = os.path.join(BACKGROUNDS_FOLDER, city_name)
+            if os.path.isdir(city_folder):
+                sources += [os.path.join(city_folder, f) for f in sorted(os.listdir(city_folder)) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+    index = {path: entry for path, entry in index.items() if path in sources}
+    built = 0
+    for path in sources:
+        if not os.path.exists(_background_cache_file(get_background_hash(path, index), target_width)):
+            get_background_array(path, target_width, index)
+            built += 1
+    # Живые записи — только пары (хэш, ширина) текущего запуска: фоны прежних ширин тоже вытесняются
+    live_files = {os.path.basename(_background_cache_file(entry['sha256'], target_width)) for entry in index.values()}
+    evicted = 0
+    if os.path.isdir(BACKGROUND_CACHE_DIR):
+        for name in os.listdir(BACKGROUND_CACHE_DIR):
+            if name.endswith('.npy') and name not in live_files:
+                os.remove(os.path.join(BACKGROUND_CACHE_DIR, name))
+                evicted += 1
+    save_background_index(index)
+    logger.info(f"Кэш фонов обновлён: добавлено {built}, удалено {evicted}, всего источников {len(sources)}.")
+    return built, evicted
+
+# --- Кэш карточек и видео ---
+def video_cache_key(card_keys: List[str], transition: str = TRANSITION_TYPE) -> str:
+    watermark_hash = file_content_hash(WATERMARK_FILE) if os.path.exists(WATERMARK_FILE) else None
+    return canonical_hash({
+        'version': VIDEO_CACHE_VERSION, 'cards': card_keys, 'transition': transition,
+        'dedupe_hold_frames': VIDEO_DEDUPE_HOLD_FRAMES, 'fps': VIDEO_FPS, 'hold_duration_sec': VIDEO_HOLD_DURATION_SEC,
+        'steps': TRANSITION_STEPS, 'watermark_sha256': watermark_hash, 'watermark_scale': WATERMARK_SCALE_FACTOR,
+        'encoding': VIDEO_ENCODING_PROFILE, **({'target_bytes': VIDEO_TARGET_BYTES} if VIDEO_ENCODING_PROFILE == "auto" else {}),
+    })
+
+def restore_cached_video(key: str, output_path: str) -> bool:
+    cache_file = os.path.join(VIDEO_CACHE_DIR, f"{key}.mp4")
+    if not os.path.exists(cache_file): return False
+    try:
+        shutil.copyfile(cache_file, output_path)
+        os.utime(cache_file)
+        return True
+    except OSError as e:
+        logger.warning(f"Не удалось взять видео из кэша: {e}")
+        return False
+
+def store_cached_video(key: str, video_path: str):
+    cache_file = os.path.join(VIDEO_CACHE_DIR, f"{key}.mp4")
+    try:
+        os.makedirs(VIDEO_CACHE_DIR, exist_ok=True)
+        tmp_path = f"{cache_file}.{os.getpid()}.tmp"
+        shutil.copyfile(video_path, tmp_path)
+        os.replace(tmp_path, cache_file)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить видео в кэш: {e}")
+
+def prune_render_cache(max_age_hours: float = RENDER_CACHE_MAX_AGE_HOURS, max_bytes: int = RENDER_CACHE_MAX_BYTES) -> int:
+    # Удаляет записи старше max_age_hours, затем самые давно использованные, пока объём не станет <= max_bytes
+    entries = []
+    for folder in (RENDER_CACHE_DIR, VIDEO_CACHE_DIR):
+        if not os.path.isdir(folder): continue
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    cutoff = time.time() - max_age_hours * 3600
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for mtime, size, path in entries:
+        if mtime >= cutoff and total <= max_bytes: break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    if removed: logger.info(f"Из кэша карточек и видео удалено записей: {removed}.")
+    return removed
 
 # --- Вспомогательные функции ---
 def get_wind_direction_abbr(deg: int) -> str:
     return ["С", "ССВ", "СВ", "ВСВ", "В", "ВЮВ", "ЮВ", "ЮЮВ", "Ю", "ЮЮЗ", "ЮЗ", "ЗЮЗ", "З", "ЗСЗ", "СЗ", "ССЗ"][round(deg / 22.5) % 16]
-def get_random_background_image(city_name: str) -> str | None:
+def get_random_background_image(city_name: str, seed: Optional[str] = None) -> str | None:
     city_folder = os.path.join(BACKGROUNDS_FOLDER, city_name)
     if os.path.isdir(city_folder):
-        import random
-        files = [f for f in os.listdir(city_folder) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
-        if files: return os.path.join(city_folder, random.choice(files))
+        files = sorted(f for f in os.listdir(city_folder) if f.lower().endswith(('.png', '.jpg', '.jpeg')))
+        if files: return os.path.join(city_folder, random.Random(seed).choice(files) if seed is not None else random.choice(files))
     return None
 def round_rectangle(draw, xy, r, fill):
     x1, y1, x2, y2 = xy
@@ -377,92 +1664,229 @@ def get_font(size: int) -> ImageFont.FreeTypeFont:
     except IOError: font = ImageFont.load_default()
     font_cache[size] = font
     return font
-def add_watermark(img: Image.Image) -> Image.Image:
+def get_watermark_layer(width: int, height: int) -> Optional[Tuple[int, int, np.ndarray, np.ndarray]]:
+    key = (width, height)
+    if key in watermark_cache: return watermark_cache[key]
+    layer = None
     try:
-        base = img.convert("RGBA")
-        if not os.path.exists(WATERMARK_FILE): return base.convert("RGB")
-        watermark = Image.open(WATERMARK_FILE).convert("RGBA")
-        w, h = base.size
-        target_w = int(w * WATERMARK_SCALE_FACTOR)
-        h_size = int(watermark.height * (target_w / watermark.width))
-        watermark = watermark.resize((target_w, h_size), Image.Resampling.LANCZOS)
-        padding = int(w * 0.02)
-        pos = (w - watermark.width - padding, padding)
-        transparent = Image.new('RGBA', base.size, (0,0,0,0)); transparent.paste(base, (0,0))
-        transparent.paste(watermark, pos, mask=watermark)
-        return transparent.convert("RGB")
+        if os.path.exists(WATERMARK_FILE):
+            watermark = Image.open(WATERMARK_FILE).convert("RGBA")
+            target_w = int(width * WATERMARK_SCALE_FACTOR)
+            h_size = int(watermark.height * (target_w / watermark.width))
+            watermark = watermark.resize((target_w, h_size), Image.Resampling.LANCZOS)
+            padding = int(width * 0.02)
+            x, y = width - watermark.width - padding, padding
+            # Обрезаем по видимой области и по границам кадра, чтобы смешивать только нужные пиксели
+            bbox = watermark.getchannel("A").getbbox()
+            if bbox:
+                left, top, right, bottom = bbox
+                left, top = max(left, -x), max(top, -y)
+                right, bottom = min(right, width - x), min(bottom, height - y)
+                if left < right and top < bottom:
+                    rgba = np.asarray(watermark.crop((left, top, right, bottom)), dtype=np.uint16)
+                    alpha = rgba[:, :, 3:4]
+                    premultiplied = np.ascontiguousarray(rgba[:, :, :3] * alpha)
+                    inverse_alpha = np.ascontiguousarray(np.broadcast_to(255 - alpha, premultiplied.shape))
+                    layer = (y + top, x + left, premultiplied, inverse_alpha)
     except Exception as e:
-        logger.error(f"Ошибка при добавлении вотермарки: {e}")
-        return img.convert("RGB")
+        logger.error(f"Ошибка при подготовке вотермарки: {e}")
+    watermark_cache[key] = layer
+    return layer
+
+def apply_watermark(frame: np.ndarray) -> np.ndarray:
+    # Альфа-композитинг вотермарки поверх кадра uint8 (H, W, 3) или пачки кадров (N, H, W, 3) на месте,
+    # целочисленная арифметика
+    layer = get_watermark_layer(frame.shape[-2], frame.shape[-3])
+    if layer is None: return frame
+    y, x, premultiplied, inverse_alpha = layer
+    h, w = premultiplied.shape[:2]
+    region = frame[..., y:y + h, x:x + w, :]
+    blended = region * inverse_alpha
+    blended += premultiplied
+    blended += 128
+    # Точное округлённое деление на 255 без операции деления
+    blended += blended >> 8
+    blended >>= 8
+    region[...] = blended
+    return frame
+
+def _init_render_worker():
+    # Воркер, запущенный через fork из --serve, наследует обработчики сигналов event loop демона и не завершался бы
+    # по SIGTERM, которым пул гасит оставшиеся процессы после гибели одного из них. Ctrl+C обрабатывает только демон.
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def create_render_executor() -> concurrent.futures.Executor:
+    if RENDER_EXECUTOR == "thread":
+        return concurrent.futures.ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+    return concurrent.futures.ProcessPoolExecutor(max_workers=RENDER_WORKERS, initializer=_init_render_worker)
+
+class RenderPool:
+    # Пул воркеров рендера, который можно пересоздать: ProcessPoolExecutor после гибели воркера (OOM, сбой
+    # в FreeType) сам не восстанавливается, и все следующие задачи сразу завершаются BrokenExecutor
+    def __init__(self):
+        self.executor = create_render_executor()
+
+    def submit(self, fn, *args) -> concurrent.futures.Future:
+        return self.executor.submit(fn, *args)
+
+    def restart(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.executor = create_render_executor()
+
+    def __enter__(self) -> "RenderPool":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.executor.shutdown()
 
 # --- Основной исполняемый блок ---
-async def main():
+async def publish_weather(bot: Optional[telegram.Bot] = None, http_client: Optional[httpx.AsyncClient] = None,
+                          render_pool: Optional[RenderPool] = None):
     logger.info("--- Запуск основного процесса ---")
     openweather_api_key = os.getenv("OPENWEATHER_API_KEY")
     telegram_bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
-    target_chat_id = os.getenv("TARGET_CHAT_ID")
-    if not all([telegram_bot_token, target_chat_id, openweather_api_key]):
+    target_chat_ids = parse_chat_ids(os.getenv("TARGET_CHAT_ID"))
+    if not all([telegram_bot_token, target_chat_ids, openweather_api_key]):
         logger.error("ОШИБКА: Отсутствуют переменные окружения.")
         return
-    bot = Bot(token=telegram_bot_token)
+    bot = bot or telegram.Bot(token=telegram_bot_token)
 
-    # Шаг 1: Удаляем старые сообщения
-    await delete_old_messages(bot, target_chat_id)
+    # Шаг 1: Удаляем старые сообщения (записи старого формата без чата относятся к первому чату)
+    with metrics.span('delete'):
+        await delete_old_messages(bot, target_chat_ids[0])
     
-    frames = []
-    for city_name, coords in CITIES.items():
-        logger.info(f"Обработка города: {city_name}...")
-        weather_data = await get_current_weather(coords, openweather_api_key)
-        
-        # Получаем данные о Качество воздуха (теперь это кортеж или None)
-        aqi_result = await get_air_quality(coords, openweather_api_key)
-
-        if weather_data:
-            precipitation_forecast_lines = format_precipitation_forecast(weather_data)
-            # Передаем aqi_result (tuple) в функцию создания кадра
-            frame = create_weather_frame(city_name, weather_data, precipitation_forecast_lines, aqi_result)
-            if frame: frames.append(frame)
-        else:
-            logger.warning(f"Нет данных для {city_name}.")
-        await asyncio.sleep(0.5)
+    # Шаг 2: Для каждого города параллельно запрашиваем данные через общий пул соединений и готовим описание
+    # карточки. Рисуются карточки в пуле воркеров уже во время кодирования, в порядке CITIES (см. iter_city_frames).
+    semaphore = asyncio.Semaphore(HTTP_MAX_CONCURRENCY)
 
-    if not frames:
-        logger.error("Не удалось создать ни одного кадра для видео.")
-        return
+    def prepare_specs(fetched: List[Tuple[Optional[Dict], Optional[Tuple[int, float]]]]) -> List[Dict[str, Any]]:
+        # Запросы городов идут параллельно и завершаются почти одновременно, поэтому прогноз всех городов
+        # анализируется одним пакетом — векторные расчёты окупаются на пакете, а не на одном городе.
+        # Индекс фонов читается один раз на запуск; хэши новых фото сохраняются до рендера, чтобы воркеры их не пересчитывали.
+        background_index = load_background_index()
+        known = dict(background_index)
+        cities = []
+        for city_name, (weather_data, aqi_result) in zip(CITIES, fetched):
+            if weather_data: cities.append((city_name, weather_data, aqi_result))
+            else: logger.warning(f"Нет данных для {city_name}.")
+        specs = []
+        for (city_name, weather_data, aqi_result), forecast in zip(cities, analyze_forecasts([data for _, data, _ in cities])):
+            logger.info(f"Обработка города: {city_name}...")
+            spec = weather_card_spec(city_name, weather_data, forecast['precipitation_lines'], aqi_result, forecast, background_index)
+            if spec: specs.append(spec)
+        update_background_index({path: entry for path, entry in background_index.items() if known.get(path) != entry})
+        return specs
 
-    video_path = "weather_report.mp4"
-    create_weather_video(frames, video_path)
+    def submit_render(spec: Dict[str, Any]) -> concurrent.futures.Future:
+        started = time.perf_counter()
+        future = render_pool.submit(load_or_render_card, spec)
+        future.add_done_callback(lambda _: metrics.record_span('render', started, time.perf_counter(), city=spec['city_name']))
+        return future
+
+    output_path = video_path = "weather_report.mp4"
+    async with contextlib.AsyncExitStack() as stack:
+        # В режиме --serve пул соединений и воркеры рендера приходят снаружи и живут между публикациями
+        if http_client is None: http_client = await stack.enter_async_context(create_http_client())
+        if render_pool is None: render_pool = stack.enter_context(RenderPool())
+        frames_yielded = 0
+        render_broken: Optional[concurrent.futures.BrokenExecutor] = None
+
+        def iter_city_frames(specs: List[Dict[str, Any]]) -> Iterator[Image.Image]:
+            # Выполняется в потоке конвейера. Рендер идёт скользящим окном: рисуются и ждут кодировщика не больше
+            # RENDER_WORKERS + RENDER_QUEUE_SIZE карточек, так что пик памяти не растёт с числом городов.
+            # Карточки отдаются строго по порядку городов, ссылка на отданную сразу отпускается.
+            nonlocal frames_yielded, render_broken
+            window: collections.deque = collections.deque()
+            pending = iter(specs)
+            try:
+                while True:
+                    try:
+                        for spec in itertools.islice(pending, RENDER_WORKERS + RENDER_QUEUE_SIZE - len(window)):
+                            window.append((spec['city_name'], submit_render(spec)))
+                        if not window: return
+                        city_name, future = window.popleft()
+                        frame = future.result()
+                    except concurrent.futures.BrokenExecutor as e:
+                        # Воркер рендера погиб — остальные карточки тоже не придут
+                        logger.error(f"Пул рендера сломан, карточки {len(specs) - frames_yielded} городов не отрисованы.")
+                        render_broken = e
+                        return
+                    except Exception as e:
+                        logger.error(f"Ошибка при рендере кадра для {city_name}: {e}")
+                        continue
+                    finally:
+                        future = None
+                    if frame:
+                        metrics.count('cards_rendered')
+                        if frame.info.get('render_cache_hit'): metrics.count('card_cache_hits')
+                        frames_yielded += 1
+                        yield frame
+                    frame = None
+            finally:
+                # Кодирование прервано — недорисованные карточки уже не нужны
+                for _, future in window: future.cancel()
+
+        fetched = await asyncio.gather(*(fetch_city(coords, openweather_api_key, http_client, semaphore, city_name)
+                                         for city_name, coords in CITIES.items()))
+        # Разбор прогнозов и хэширование новых фонов — вне цикла событий
+        specs = await asyncio.to_thread(prepare_specs, fetched)
+        # Если ни одна карточка не изменилась с прошлого запуска, повторно используем готовое видео
+        card_keys = [spec['key'] for spec in specs]
+        video_key = video_cache_key(card_keys)
+        if card_keys and restore_cached_video(video_key, video_path):
+            metrics.count('video_cache_hits')
+            logger.info("Все карточки без изменений, видео взято из кэша.")
+        else:
+            # Шаг 3: Кодирование видео потоковым конвейером в отдельном потоке, event loop остаётся свободным.
+            # Если погиб воркер рендера, пул пересоздаётся и видео собирается заново — уже отрисованные
+            # карточки берутся из кэша рендера. Вторая неудача прерывает публикацию, неполное видео не отправляется.
+            for attempt in range(2):
+                frames_yielded, render_broken = 0, None
+                video_stats: Dict[str, float] = {}
+                city_frames = iter_city_frames(specs)
+                with metrics.span('encode', attempt=attempt):
+                    try:
+                        video_path = await asyncio.to_thread(create_weather_video, city_frames, output_path, stats=video_stats,
+                                                             expected_cards=len(card_keys))
+                    finally:
+                        city_frames.close()
+                if render_broken is None: break
+                if os.path.exists(output_path): os.remove(output_path)
+                if attempt == 1: raise render_broken
+                logger.error(f"Пул рендера сломан ({render_broken}), создаём новый и собираем видео заново.")
+                metrics.count('render_pool_restarts')
+                render_pool.restart()
+            metrics.count('frames_written', video_stats.get('frames_written', 0))
+            metrics.extra['video'] = video_stats
+            # Видео без части карточек в кэш не кладём — иначе следующий запуск возьмёт неполное
+            if video_path and frames_yielded == len(card_keys): store_cached_video(video_key, video_path)
+    prune_render_cache()
 
-    message_sent_successfully = False
-    new_message_id = None
-    
     if os.path.exists(video_path):
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton(AD_BUTTON_TEXT, url=AD_BUTTON_URL), InlineKeyboardButton(NEWS_BUTTON_TEXT, url=NEWS_BUTTON_URL)]])
+        keyboard = telegram.InlineKeyboardMarkup([[telegram.InlineKeyboardButton(AD_BUTTON_TEXT, url=AD_BUTTON_URL),
+                                                   telegram.InlineKeyboardButton(NEWS_BUTTON_TEXT, url=NEWS_BUTTON_URL)]])
+        sent_messages: Dict[str, int] = {}
         try:
-            with open(video_path, 'rb') as video_file:
-                message = await bot.send_animation(
-                    chat_id=target_chat_id, 
-                    animation=video_file,
-                    disable_notification=True, 
-                    reply_markup=keyboard
-                    # Удаленный аргумент timeout=120
-                )
-            new_message_id = message.message_id
-            logger.info(f"Анимация MP4 отправлена. ID: {new_message_id}.")
-            message_sent_successfully = True
-
-            # --- Искусственный таймаут ---
-            await asyncio.sleep(10) 
-            logger.info("Пауза в 10 секунд после отправки анимации завершена.")
-            # --- Конец искусственного таймаута ---
+            with metrics.span('publish', chats=len(target_chat_ids)):
+                sent_messages = await publish_video(bot, target_chat_ids, video_path, disable_notification=True, reply_markup=keyboard)
+
+            if sent_messages:
+                # --- Искусственный таймаут ---
+                await asyncio.sleep(POST_PUBLISH_DELAY_SEC)
+                logger.info(f"Пауза в {POST_PUBLISH_DELAY_SEC:g} секунд после отправки анимации завершена.")
+                # --- Конец искусственного таймаута ---
 
         except Exception as e:
             logger.error(f"Ошибка при отправке MP4: {e}")
         finally:
-            if message_sent_successfully and new_message_id:
-                save_message_id(new_message_id)
-            elif not message_sent_successfully:
-                logger.warning("Новое сообщение не было отправлено или его ID не получен, запись не будет сохранена.")
+            # ID сообщения сохраняется отдельно для каждого чата — для удаления при следующем запуске
+            for chat_id, message_id in sent_messages.items():
+                save_message_id(message_id, chat_id)
+            not_sent = [chat_id for chat_id in target_chat_ids if chat_id not in sent_messages]
+            if not_sent:
+                logger.warning(f"Сообщение не было отправлено в чаты {not_sent}, запись для них не будет сохранена.")
 
             if os.path.exists(video_path): 
                 os.remove(video_path)
@@ -471,7 +1895,225 @@ async def main():
     
     logger.info("--- Завершение работы ---")
 
+def start_profiling() -> Dict[str, Any]:
+    modes = {mode.strip() for mode in WEATHER_PROFILE.split(",") if mode.strip()}
+    profiling: Dict[str, Any] = {}
+    if "tracemalloc" in modes:
+        import tracemalloc
+        tracemalloc.start()
+        profiling['tracemalloc'] = tracemalloc
+    if "cprofile" in modes:
+        import cProfile
+        profiling['cprofile'] = cProfile.Profile()
+        profiling['cprofile'].enable()
+    return profiling
+
+def stop_profiling(profiling: Dict[str, Any]):
+    # cProfile видит только поток event loop; рендер в процессах и поток кодировщика в профиль не попадают
+    if 'cprofile' in profiling:
+        profiling['cprofile'].disable()
+        profiling['cprofile'].dump_stats(PROFILE_OUTPUT_FILE)
+        logger.info(f"Профиль cProfile записан в {PROFILE_OUTPUT_FILE}.")
+    if 'tracemalloc' in profiling:
+        tracemalloc = profiling['tracemalloc']
+        current, peak = tracemalloc.get_traced_memory()
+        top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+        tracemalloc.stop()
+        metrics.extra['tracemalloc'] = {'current_bytes': current, 'peak_bytes': peak,
+                                        'top': [{'where': str(stat.traceback), 'size_bytes': stat.size, 'count': stat.count} for stat in top]}
+
+async def main(**resources):
+    metrics.reset()
+    profiling = start_profiling()
+    try:
+        await publish_weather(**resources)
+    finally:
+        stop_profiling(profiling)
+        metrics.write_report(RUN_REPORT_FILE)
+
+# --- Режим демона (--serve) ---
+class CronSchedule:
+    # Пять полей cron (минута, час, день месяца, месяц, день недели; 0 и 7 — воскресенье): *, списки, диапазоны, шаг /N.
+    # Время — UTC, как у schedule в GitHub Actions.
+    FIELD_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5: raise ValueError(f"Ожидается 5 полей cron, получено: {expression!r}")
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (self._parse_field(field, low, high) for field, (low, high) in zip(fields, self.FIELD_RANGES))
+        self.weekdays = {day % 7 for day in weekdays}
+        # Как в cron: если заданы и день месяца, и день недели, достаточно совпадения любого из них
+        self.days_any, self.weekdays_any = fields[2] == '*', fields[4] == '*'
+
+    @staticmethod
+    def _parse_field(field: str, low: int, high: int) -> set:
+        values = set()
+        for part in field.split(','):
+            body, _, step = part.partition('/')
+            if body == '*': start, end = low, high
+            elif '-' in body: start, end = (int(v) for v in body.split('-', 1))
+            else: start = end = int(body)
+            if step and body != '*' and '-' not in body: end = high
+            if not low <= start <= end <= high or (step and int(step) < 1):
+                raise ValueError(f"Недопустимое поле cron: {field!r}")
+            values.update(range(start, end + 1, int(step) if step else 1))
+        return values
+
+    def _day_matches(self, moment: datetime.datetime) -> bool:
+        day_ok = moment.day in self.days
+        weekday_ok = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.days_any or self.weekdays_any: return day_ok and weekday_ok
+        return day_ok or weekday_ok
+
+    def next_after(self, moment: datetime.datetime) -> datetime.datetime:
+        # Ближайший момент строго после moment; несовпадающие месяц/день/час пропускаются целиком
+        t = moment.astimezone(datetime.timezone.utc).replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+        limit = t + datetime.timedelta(days=366 * 5)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + datetime.timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += datetime.timedelta(minutes=1)
+            else:
+                return t
+        raise ValueError(f"Расписание {self.expression!r} никогда не срабатывает")
+
+def load_serve_state() -> Dict[str, Any]:
+    return read_json(SERVE_STATE_FILE, {})
+
+def save_serve_state(state: Dict[str, Any]):
+    try:
+        write_json_atomic(SERVE_STATE_FILE, state, ensure_ascii=False, indent=1)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить состояние демона: {e}")
+
+def first_due_time(schedule: CronSchedule, state: Dict[str, Any], now: datetime.datetime) -> datetime.datetime:
+    # Запуск, пропущенный пока демон был остановлен, выполняется сразу, если опоздание не больше SERVE_CATCH_UP_MINUTES
+    last_slot = state.get('last_slot')
+    if last_slot:
+        missed = schedule.next_after(datetime.datetime.fromisoformat(last_slot))
+        if missed <= now and now - missed <= datetime.timedelta(minutes=SERVE_CATCH_UP_MINUTES):
+            logger.info(f"Пропущенная публикация {missed.isoformat()} будет выполнена сейчас.")
+            return missed
+    return schedule.next_after(now)
+
+async def serve(schedule_expression: str = SERVE_SCHEDULE):
+    # Резидентный процесс: шрифты, водяной знак и фоны остаются в памяти (в том числе у воркеров рендера),
+    # пул HTTP-соединений и сессия бота переиспользуются. Состояние (последний слот) переживает перезапуск.
+    schedule = CronSchedule(schedule_expression)
+    telegram_bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
+    if not all([telegram_bot_token, os.getenv("TARGET_CHAT_ID"), os.getenv("OPENWEATHER_API_KEY")]):
+        logger.error("ОШИБКА: Отсутствуют переменные окружения.")
+        return
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try: loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError): pass  # Windows: остаётся только Ctrl+C
+
+    state = load_serve_state()
+    async with contextlib.AsyncExitStack() as stack:
+        bot = await stack.enter_async_context(telegram.Bot(token=telegram_bot_token))
+        http_client = await stack.enter_async_context(create_http_client())
+        # Пул рендера живёт между публикациями; погибший воркер publish_weather заменяет сама (RenderPool.restart)
+        render_pool = stack.enter_context(RenderPool())
+        due = first_due_time(schedule, state, datetime.datetime.now(datetime.timezone.utc))
+        logger.info(f"Демон запущен, расписание '{schedule.expression}' (UTC).")
+
+        while not stop.is_set():
+            delay = (due - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+            if delay > 0:
+                logger.info(f"Следующая публикация: {due.isoformat()} (через {delay / 60:.0f} мин).")
+                # Ожидание короткими отрезками, чтобы не разойтись с настенными часами после сна системы
+                while delay > 0 and not stop.is_set():
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(stop.wait(), timeout=min(delay, SERVE_MAX_SLEEP_SEC))
+                    delay = (due - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+                if stop.is_set(): break
+
+            # Публикация не прерывается сигналом: SIGTERM во время неё завершит демон после отправки
+            try:
+                await asyncio.to_thread(refresh_background_cache)
+                await main(bot=bot, http_client=http_client, render_pool=render_pool)
+            except Exception as e:
+                logger.exception(f"Ошибка публикации по расписанию: {e}")
+            state.update(last_slot=due.isoformat(), last_finished_at=datetime.datetime.now(datetime.timezone.utc).isoformat())
+            save_serve_state(state)
+            due = schedule.next_after(max(due, datetime.datetime.now(datetime.timezone.utc)))
+    logger.info("Демон остановлен.")
+
+# --- Проверка конфигурации (--check) ---
+def check_configuration(online: bool = True) -> Tuple[List[str], List[str]]:
+    # Проверяет окружение, ассеты и учётные данные, не загружая медиа-стек и ничего не записывая на диск.
+    # Возвращает (проблемы, предупреждения): предупреждения — то, с чем публикация всё равно пройдёт.
+    problems, warnings = [], []
+    telegram_bot_token = os.getenv("TELEGRAM_BOT_TOKEN")
+    openweather_api_key = os.getenv("OPENWEATHER_API_KEY")
+    target_chat_ids = parse_chat_ids(os.getenv("TARGET_CHAT_ID"))
+    for name, value in (("TELEGRAM_BOT_TOKEN", telegram_bot_token), ("OPENWEATHER_API_KEY", openweather_api_key), ("TARGET_CHAT_ID", target_chat_ids)):
+        if not value: problems.append(f"Не задана переменная окружения {name}.")
+    if telegram_bot_token and not re.fullmatch(r"\d+:[\w-]{20,}", telegram_bot_token):
+        problems.append("TELEGRAM_BOT_TOKEN не похож на токен бота (<id>:<секрет>).")
+
+    for module in ("numpy", "PIL", "imageio", "imageio_ffmpeg", "telegram", "yaml", "httpx"):
+        if importlib.util.find_spec(module) is None: problems.append(f"Не установлен модуль {module}.")
+    if TRANSITION_TYPE not in TRANSITION_TYPES: problems.append(f"Неизвестный TRANSITION_TYPE: {TRANSITION_TYPE}.")
+    if VIDEO_ENCODING_PROFILE not in (*ENCODING_PROFILES, "auto"): problems.append(f"Неизвестный VIDEO_ENCODING_PROFILE: {VIDEO_ENCODING_PROFILE}.")
+    if MESSAGE_STORE_BACKEND not in ("sqlite", "yaml"): problems.append(f"Неизвестный MESSAGE_STORE_BACKEND: {MESSAGE_STORE_BACKEND}.")
+    try: CronSchedule(SERVE_SCHEDULE)
+    except ValueError as e: problems.append(str(e))
+
+    if not os.path.exists("arial.ttf"): warnings.append("Нет шрифта arial.ttf, будет использован шрифт по умолчанию.")
+    if not os.path.exists(WATERMARK_FILE): problems.append(f"Нет файла водяного знака {WATERMARK_FILE}.")
+    for city_name in CITIES:
+        if get_random_background_image(city_name) is None: problems.append(f"Нет фоновых изображений для {city_name} в {BACKGROUNDS_FOLDER}.")
+    for folder in (BACKGROUND_CACHE_DIR, RENDER_CACHE_DIR, VIDEO_CACHE_DIR, API_CACHE_DIR):
+        # Папки кэша не создаются: достаточно, чтобы их (или ближайшую существующую родительскую) можно было записать
+        existing = folder
+        while not os.path.exists(existing) and os.path.dirname(existing) != existing: existing = os.path.dirname(existing) or "."
+        if not os.access(existing, os.W_OK): problems.append(f"Папка кэша {folder} недоступна для записи ({existing}).")
+
+    if online and telegram_bot_token and openweather_api_key:
+        # Учётные данные проверяются прямыми запросами, без импорта python-telegram-bot
+        coords = next(iter(CITIES.values()))
+        with httpx.Client(timeout=HTTP_TIMEOUT_SEC) as client:
+            try:
+                response = client.get(f"https://api.telegram.org/bot{telegram_bot_token}/getMe")
+                if response.status_code != 200: problems.append(f"Telegram отклонил токен бота (HTTP {response.status_code}).")
+                else: logger.info(f"Бот: @{response.json()['result'].get('username')}.")
+                response = client.get(OPENWEATHER_API_URL, params={"lat": coords["lat"], "lon": coords["lon"], "appid": openweather_api_key, "exclude": "minutely,hourly,daily,alerts"})
+                if response.status_code != 200: problems.append(f"OpenWeather отклонил ключ API (HTTP {response.status_code}).")
+            except httpx.HTTPError as e:
+                # Без текста исключения: в нём может оказаться URL с токеном
+                problems.append(f"Не удалось проверить учётные данные: сетевая ошибка {type(e).__name__}.")
+    return problems, warnings
+
 if __name__ == "__main__":
-    if os.name == 'nt':
-        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
-    asyncio.run(main())
+    import argparse
+    parser = argparse.ArgumentParser(description="Публикация сводки погоды в Telegram")
+    parser.add_argument("--build-background-cache", action="store_true",
+                        help="только обновить кэш уменьшенных фонов и выйти")
+    parser.add_argument("--check", action="store_true",
+                        help="проверить переменные окружения, ассеты и учётные данные без публикации")
+    parser.add_argument("--offline", action="store_true", help="для --check: не обращаться к Telegram и OpenWeather")
+    parser.add_argument("--serve", action="store_true",
+                        help=f"работать постоянно и публиковать по расписанию SERVE_SCHEDULE ('{SERVE_SCHEDULE}', UTC)")
+    args = parser.parse_args()
+    if args.check:
+        problems, warnings = check_configuration(online=not args.offline)
+        for warning in warnings: logger.warning(warning)
+        for problem in problems: logger.error(problem)
+        if not problems: logger.info("Конфигурация в порядке.")
+        raise SystemExit(1 if problems else 0)
+    if args.build_background_cache:
+        refresh_background_cache()
+    else:
+        if os.name == 'nt':
+            asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+        asyncio.run(serve() if args.serve else main())